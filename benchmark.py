@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+###############################################################################
+##
+## Copyright (C) 2010  Thammi
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+from argparse import ArgumentParser
+from timeit import default_timer
+from math import cos, sin, pi
+
+import ucgf
+import obj_parser
+import mesh_math
+import flat
+import point_cloud
+
+class Quiet:
+
+    # some of the measured code still likes to talk, keep stdout clean for json
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def write_mesh(file_name, sphere):
+    out = open(file_name, 'w')
+
+    for vertex in sphere.positions:
+        out.write("v %f %f %f\n" % tuple(vertex))
+
+    for face in sphere.indices + 1:
+        out.write("f %i %i %i\n" % tuple(face))
+
+    out.close()
+
+def write_polygons(file_name, sizes):
+    # a row of flat star shaped polygons with the given numbers of corners,
+    # hard work for the ear clipping
+    out = open(file_name, 'w')
+
+    for index, corners in enumerate(sizes):
+        for corner in range(corners):
+            angle = corner * pi * 2 / corners
+            radius = 1 if corner % 2 else 0.4
+            out.write("v %f %f %f\n" % (index * 3 + cos(angle) * radius, sin(angle) * radius, 0))
+
+    start = 1
+    for corners in sizes:
+        out.write("f %s\n" % ' '.join(str(i) for i in range(start, start + corners)))
+        start += corners
+
+    out.close()
+
+def write_cloud(file_name, sphere):
+    out = open(file_name, 'w')
+
+    for vertex in sphere.positions:
+        out.write("v %f %f %f\n" % tuple(vertex))
+        out.write("vn %f %f %f\n" % tuple(vertex * 2))
+
+    out.close()
+
+class Inputs:
+
+    def __init__(self, detail):
+        self.dir_name = tempfile.mkdtemp(prefix='ucgf-bench-')
+
+        # keeps the temporary meshes out of the user's cache until close()
+        self.mesh_cache = obj_parser.mesh_cache
+        obj_parser.mesh_cache = obj_parser.MeshCache(os.path.join(self.dir_name, 'cache'))
+
+        sphere = ucgf.Sphere(detail)
+
+        self.mesh = os.path.join(self.dir_name, 'mesh.obj')
+        write_mesh(self.mesh, sphere)
+
+        self.polygons = os.path.join(self.dir_name, 'polygons.obj')
+        # small concave ones too, their ears come back as short lists
+        write_polygons(self.polygons, [64] * 16 + [5, 6, 7, 9, 12, 33])
+
+        self.cloud = os.path.join(self.dir_name, 'cloud.pobj')
+        write_cloud(self.cloud, sphere)
+
+        self.out = os.path.join(self.dir_name, 'out.obj')
+
+        self.points = [ucgf.Vector(cos(i), sin(i * 0.7)) for i in range(8)]
+
+    def close(self):
+        obj_parser.mesh_cache = self.mesh_cache
+        shutil.rmtree(self.dir_name)
+
+# every benchmark prepares fresh state and returns the function to be timed
+
+def bench_sphere(inp):
+    def run():
+        ucgf.sphere_meshes.clear()
+        ucgf.Sphere(5)
+
+    return run
+
+def bench_tube(inp):
+    return lambda: ucgf.Tube(4096)
+
+def bench_obj_parse(inp):
+    return lambda: obj_parser.ObjObject(inp.mesh, cache=False)
+
+def bench_obj_save(inp):
+    obj = obj_parser.ObjObject(inp.mesh)
+    return lambda: obj.save_obj(inp.out)
+
+def bench_smooth(inp):
+    obj = obj_parser.ObjObject(inp.mesh)
+    return lambda: obj.smooth(0.3, 2)
+
+def bench_triangulate(inp):
+    obj = obj_parser.ObjObject(inp.polygons)
+    corners, sizes = obj.face_array, obj.face_sizes
+
+    def run():
+        obj.set_face_arrays(corners, sizes)
+        obj.triangulate()
+
+    return run
+
+def bench_surface(inp):
+    obj = obj_parser.ObjObject(inp.mesh)
+    return lambda: mesh_math.surface(obj)
+
+def bench_volume(inp):
+    obj = obj_parser.ObjObject(inp.mesh)
+    return lambda: mesh_math.volume(obj)
+
+def curve_bench(curve):
+    def setup(inp):
+        pipe = curve(inp.points)
+        return lambda: list(pipe.pipe_points(100))
+
+    return setup
+
+def bench_load_cloud(inp):
+    return lambda: point_cloud.load_cloud(inp.cloud)
+
+BENCHMARKS = [
+        ('sphere', bench_sphere),
+        ('tube', bench_tube),
+        ('obj_parse', bench_obj_parse),
+        ('obj_save', bench_obj_save),
+        ('smooth', bench_smooth),
+        ('triangulate', bench_triangulate),
+        ('surface', bench_surface),
+        ('volume', bench_volume),
+        ('curve_bezier', curve_bench(flat.BezierPipe)),
+        ('curve_lagrange', curve_bench(flat.Lagrange)),
+        ('curve_cox_de_boor', curve_bench(flat.CoxDeBoor)),
+        ('load_cloud', bench_load_cloud),
+        ]
+
+def measure(setup, inp, warmup, trials):
+    times = []
+
+    for index in range(warmup + trials):
+        fun = setup(inp)
+
+        with Quiet():
+            start = default_timer()
+            fun()
+            end = default_timer()
+
+        if index >= warmup:
+            times.append(end - start)
+
+    times.sort()
+
+    return {
+            'min': times[0],
+            'median': times[len(times) // 2],
+            'mean': sum(times) / len(times),
+            'max': times[-1],
+            'trials': times,
+            }
+
+def run(names, detail=4, warmup=1, trials=5):
+    inp = Inputs(detail)
+
+    try:
+        results = {}
+
+        for name, setup in BENCHMARKS:
+            if names and name not in names:
+                continue
+
+            results[name] = measure(setup, inp, warmup, trials)
+    finally:
+        inp.close()
+
+    return {
+            'meta': {
+                'time': time.time(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'detail': detail,
+                'warmup': warmup,
+                'trials': trials,
+                },
+            'results': results,
+            }
+
+def compare(report, baseline, threshold):
+    regressions = []
+    comparison = {}
+
+    for name, result in report['results'].items():
+        if name not in baseline['results']:
+            continue
+
+        ratio = result['median'] / baseline['results'][name]['median']
+        regression = ratio > 1 + threshold
+
+        comparison[name] = {'ratio': ratio, 'regression': regression}
+
+        if regression:
+            regressions.append(name)
+
+    report['comparison'] = comparison
+
+    return regressions
+
+def main(argv):
+    parser = ArgumentParser(description="Headless benchmarks of the CPU hot paths")
+    parser.add_argument('names', nargs='*', help="benchmarks to run, all by default")
+    parser.add_argument('-l', '--list', action='store_true', help="list available benchmarks")
+    parser.add_argument('-d', '--detail', type=int, default=4, help="sphere detail of the test meshes")
+    parser.add_argument('-w', '--warmup', type=int, default=1, help="untimed runs before the trials")
+    parser.add_argument('-n', '--trials', type=int, default=5, help="timed runs per benchmark")
+    parser.add_argument('-o', '--output', help="write the json report to this file")
+    parser.add_argument('-c', '--compare', help="json report to compare against")
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+            help="allowed slowdown of the median before flagging a regression")
+
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, setup in BENCHMARKS:
+            print name
+        return 0
+
+    report = run(args.names, args.detail, args.warmup, args.trials)
+
+    regressions = []
+
+    if args.compare:
+        baseline = json.load(open(args.compare))
+        regressions = compare(report, baseline, args.threshold)
+
+        for name in regressions:
+            ratio = report['comparison'][name]['ratio']
+            sys.stderr.write("Regression in %s: %.2fx slower\n" % (name, ratio))
+
+    data = json.dumps(report, indent=2, sort_keys=True, separators=(',', ': '))
+
+    if args.output:
+        out = open(args.output, 'w')
+        out.write(data)
+        out.close()
+    else:
+        print data
+
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+###############################################################################
+##
+## Copyright (C) 2010  Thammi
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+import os
+import time
+import hashlib
+
+import numpy
+
+# queries are answered this many at a time, keeps the work lists bounded
+QUERY_BLOCK = 1 << 14
+
+# an odd direction for the inside test, rays along it rarely graze edges
+INSIDE_DIRECTION = numpy.array([0.8191, 0.4226, 0.3881])
+
+def box_area(lo, hi):
+    size = numpy.maximum(hi - lo, 0)
+    return 2 * (size[..., 0] * size[..., 1] + size[..., 1] * size[..., 2] + size[..., 2] * size[..., 0])
+
+def ramp(counts):
+    # 0 to count - 1 for every count, all in one row
+    return numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+
+def dot(a, b):
+    return (a * b).sum(-1)
+
+def ray_triangles(origins, directions, corners):
+    # distance along each ray to its triangle, inf if it misses (moeller trumbore)
+    a, b, c = corners[:, 0], corners[:, 1], corners[:, 2]
+
+    ab = b - a
+    ac = c - a
+    p = numpy.cross(directions, ac)
+    det = dot(ab, p)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        inv = 1. / det
+
+        s = origins - a
+        u = dot(s, p) * inv
+        q = numpy.cross(s, ab)
+        v = dot(directions, q) * inv
+        t = dot(ac, q) * inv
+
+        hit = (det != 0) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0)
+
+    return numpy.where(hit, t, numpy.inf)
+
+def closest_points(points, corners):
+    # the closest point on each triangle, going through the voronoi regions
+    # of corners, edges and the face (Ericson, "Real-Time Collision Detection")
+    a, b, c = corners[:, 0], corners[:, 1], corners[:, 2]
+
+    ab = b - a
+    ac = c - a
+    ap = points - a
+    bp = points - b
+    cp = points - c
+
+    d1, d2 = dot(ab, ap), dot(ac, ap)
+    d3, d4 = dot(ab, bp), dot(ac, bp)
+    d5, d6 = dot(ab, cp), dot(ac, cp)
+
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        total = va + vb + vc
+        result = a + ab * (vb / total)[:, None] + ac * (vc / total)[:, None]
+
+        # the regions in reverse, so the first one that matches wins
+        regions = [
+                ((va <= 0) & (d4 >= d3) & (d5 >= d6),
+                    lambda: b + (c - b) * ((d4 - d3) / ((d4 - d3) + (d5 - d6)))[:, None]),
+                ((vb <= 0) & (d2 >= 0) & (d6 <= 0), lambda: a + ac * (d2 / (d2 - d6))[:, None]),
+                ((d6 >= 0) & (d5 <= d6), lambda: c),
+                ((vc <= 0) & (d1 >= 0) & (d3 <= 0), lambda: a + ab * (d1 / (d1 - d3))[:, None]),
+                ((d3 >= 0) & (d4 <= d3), lambda: b),
+                ((d1 <= 0) & (d2 <= 0), lambda: a),
+                ]
+
+        for chosen, point in regions:
+            result = numpy.where(chosen[:, None], point(), result)
+
+    return result
+
+class BVH:
+
+    # a binary tree of boxes over triangles in flat arrays. inner nodes have
+    # a count of 0 and their children at first and first + 1, leaves hold
+    # the triangles first to first + count of the reordered corners
+
+    def __init__(self, corners, lo, hi, first, count, order):
+        self.corners = corners[order]
+        self.lo = lo
+        self.hi = hi
+        self.first = first
+        self.count = count
+        self.order = order
+
+    @classmethod
+    def build(cls, corners, leaf_size=4, bins=16):
+        # binned surface area heuristic, all nodes of a level are split at once
+        corners = numpy.asarray(corners, numpy.float64).reshape(-1, 3, 3)
+        n = len(corners)
+
+        tri_lo = corners.min(1)
+        tri_hi = corners.max(1)
+        centers = (tri_lo + tri_hi) * 0.5
+
+        size = max(2 * n - 1, 1)
+        lo = numpy.zeros((size, 3))
+        hi = numpy.zeros((size, 3))
+        first = numpy.zeros(size, numpy.int32)
+        count = numpy.zeros(size, numpy.int32)
+        order = numpy.arange(n)
+
+        if n:
+            lo[0], hi[0] = tri_lo.min(0), tri_hi.max(0)
+            count[0] = n
+
+        total = 1
+        active = numpy.arange(1 if n > leaf_size else 0)
+
+        while len(active):
+            starts, sizes = first[active].astype(numpy.int64), count[active].astype(numpy.int64)
+            k = len(active)
+
+            seg = numpy.repeat(numpy.arange(k), sizes)
+            offsets = numpy.cumsum(sizes) - sizes
+            index = numpy.repeat(starts, sizes) + ramp(sizes)
+            prims = order[index]
+
+            c = centers[prims]
+            c_lo = numpy.minimum.reduceat(c, offsets)
+            extent = numpy.maximum.reduceat(c, offsets) - c_lo
+
+            best_cost = numpy.repeat(numpy.inf, k)
+            best_axis = numpy.zeros(k, numpy.int64)
+            best_bin = numpy.zeros(k, numpy.int64)
+            binned = []
+
+            for axis in range(3):
+                with numpy.errstate(divide='ignore'):
+                    scale = numpy.where(extent[:, axis] > 0, bins / extent[:, axis], 0)
+
+                b = numpy.minimum(((c[:, axis] - c_lo[seg, axis]) * scale[seg]).astype(numpy.int64), bins - 1)
+                binned.append(b)
+
+                # the bounds of the bins, by sorting the triangles into them
+                keys = seg * bins + b
+                sorting = numpy.argsort(keys, kind='mergesort')
+                heads = numpy.flatnonzero(numpy.concatenate(([True], keys[sorting][1:] != keys[sorting][:-1])))
+                used = keys[sorting][heads]
+
+                bin_lo = numpy.full((k * bins, 3), numpy.inf)
+                bin_hi = numpy.full((k * bins, 3), -numpy.inf)
+                bin_lo[used] = numpy.minimum.reduceat(tri_lo[prims][sorting], heads)
+                bin_hi[used] = numpy.maximum.reduceat(tri_hi[prims][sorting], heads)
+                bin_lo = bin_lo.reshape(k, bins, 3)
+                bin_hi = bin_hi.reshape(k, bins, 3)
+
+                left_n = numpy.cumsum(numpy.bincount(keys, minlength=k * bins).reshape(k, bins), 1)
+                right_n = sizes[:, None] - left_n
+
+                left = box_area(numpy.minimum.accumulate(bin_lo, 1), numpy.maximum.accumulate(bin_hi, 1))
+                right = box_area(numpy.minimum.accumulate(bin_lo[:, ::-1], 1)[:, ::-1],
+                        numpy.maximum.accumulate(bin_hi[:, ::-1], 1)[:, ::-1])
+
+                # splitting after each bin but the last
+                cost = left_n[:, :-1] * left[:, :-1] + right_n[:, :-1] * right[:, 1:]
+                cost[(left_n[:, :-1] == 0) | (right_n[:, :-1] == 0)] = numpy.inf
+
+                j = cost.argmin(1)
+                cost = cost[numpy.arange(k), j]
+
+                better = cost < best_cost
+                best_cost[better] = cost[better]
+                best_axis[better] = axis
+                best_bin[better] = j[better]
+
+            # a split has to pay for visiting one more node
+            area = box_area(lo[active], hi[active])
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                keep = (best_cost / area + 1 >= sizes) & (sizes <= 4 * leaf_size)
+
+            # nothing to tell the triangles apart, halve them
+            stuck = numpy.isinf(best_cost) & ~keep
+            split = ~keep
+
+            side = numpy.array(binned)[best_axis[seg], numpy.arange(len(prims))] > best_bin[seg]
+            position = index - starts[seg]
+            side[stuck[seg]] = (position >= sizes[seg] // 2)[stuck[seg]]
+
+            # partition the triangles of every split node, left ones first
+            chosen = split[seg]
+            sorting = numpy.argsort(seg[chosen] * 2 + side[chosen], kind='mergesort')
+            order[index[chosen]] = prims[chosen][sorting]
+
+            parents = active[split]
+            left_n = numpy.bincount(seg[chosen & ~side], minlength=k)[split]
+            children = total + 2 * numpy.arange(len(parents))
+
+            first[children] = first[parents]
+            count[children] = left_n
+            first[children + 1] = first[parents] + left_n
+            count[children + 1] = count[parents] - left_n
+
+            first[parents] = children
+            count[parents] = 0
+            total += 2 * len(parents)
+
+            nodes = numpy.column_stack((children, children + 1)).ravel()
+            node_sizes = count[nodes].astype(numpy.int64)
+            placed = order[numpy.repeat(first[nodes], node_sizes) + ramp(node_sizes)]
+            heads = numpy.cumsum(node_sizes) - node_sizes
+
+            lo[nodes] = numpy.minimum.reduceat(tri_lo[placed], heads)
+            hi[nodes] = numpy.maximum.reduceat(tri_hi[placed], heads)
+
+            active = nodes[node_sizes > leaf_size]
+
+        return cls(corners, lo[:total], hi[:total], first[:total], count[:total], order)
+
+    @classmethod
+    def load(cls, file_name, corners):
+        data = numpy.load(file_name)
+        corners = numpy.asarray(corners, numpy.float64).reshape(-1, 3, 3)
+
+        return cls(corners, *(data[name] for name in ('lo', 'hi', 'first', 'count', 'order')))
+
+    def save(self, file_name, **extra):
+        out = open(file_name, 'wb')
+
+        try:
+            numpy.savez(out, lo=self.lo, hi=self.hi, first=self.first, count=self.count,
+                    order=self.order, **extra)
+        finally:
+            out.close()
+
+    def leaf_triangles(self, queries, nodes):
+        # pairs of query and triangle for the leaves, children for the rest
+        leaf = self.count[nodes] > 0
+
+        counts = self.count[nodes[leaf]]
+        triangles = numpy.repeat(self.first[nodes[leaf]], counts) + ramp(counts)
+        pairs = numpy.repeat(queries[leaf], counts), triangles
+
+        inner = ~leaf
+        children = (self.first[nodes[inner], None] + numpy.arange(2)).ravel()
+
+        return pairs, (numpy.repeat(queries[inner], 2), children)
+
+    def box_hits(self, origins, inverse, nodes):
+        # entry and exit distance of the rays through the boxes
+        with numpy.errstate(invalid='ignore'):
+            near = (self.lo[nodes] - origins) * inverse
+            far = (self.hi[nodes] - origins) * inverse
+
+            enter = numpy.nanmax(numpy.minimum(near, far), 1)
+            leave = numpy.nanmin(numpy.maximum(near, far), 1)
+
+        return enter, leave
+
+    def ray_hits(self, origins, directions, nearest=True):
+        # walks all rays down the tree together, a level per step
+        q = len(origins)
+        best = numpy.repeat(numpy.inf, q)
+        hits = numpy.repeat(-1, q)
+        crossings = numpy.zeros(q, numpy.int64)
+
+        with numpy.errstate(divide='ignore'):
+            inverse = 1. / directions
+
+        rays = numpy.arange(q if len(self.count) and len(self.corners) else 0)
+        nodes = numpy.zeros(len(rays), numpy.int64)
+
+        while len(rays):
+            enter, leave = self.box_hits(origins[rays], inverse[rays], nodes)
+            alive = (enter <= leave) & (leave >= 0)
+
+            if nearest:
+                alive &= enter <= best[rays]
+
+            (ray_i, tri_i), (rays, nodes) = self.leaf_triangles(rays[alive], nodes[alive])
+
+            t = ray_triangles(origins[ray_i], directions[ray_i], self.corners[tri_i])
+            hit = t < numpy.inf
+
+            if nearest:
+                numpy.minimum.at(best, ray_i[hit], t[hit])
+                closest = hit & (t == best[ray_i])
+                hits[ray_i[closest]] = tri_i[closest]
+            else:
+                crossings += numpy.bincount(ray_i[hit], minlength=q)
+
+        return best, hits, crossings
+
+    def given_triangles(self, hits):
+        # back to the order the triangles were built from, misses stay -1
+        found = hits >= 0
+        triangles = numpy.repeat(-1, len(hits))
+        triangles[found] = self.order[hits[found]]
+
+        return triangles
+
+    def intersect(self, origins, directions):
+        # the distance to the first triangle along every ray and the index of
+        # that triangle, inf and -1 if there is none
+        origins = numpy.asarray(origins, numpy.float64).reshape(-1, 3)
+        directions = numpy.asarray(directions, numpy.float64).reshape(-1, 3)
+
+        distances = numpy.repeat(numpy.inf, len(origins))
+        triangles = numpy.repeat(-1, len(origins))
+
+        for start in range(0, len(origins), QUERY_BLOCK):
+            block = slice(start, start + QUERY_BLOCK)
+            best, hits, _ = self.ray_hits(origins[block], directions[block])
+
+            distances[block] = best
+            triangles[block] = self.given_triangles(hits)
+
+        return distances, triangles
+
+    def inside(self, points):
+        # odd crossings of a ray mean inside, that needs a closed mesh
+        points = numpy.asarray(points, numpy.float64).reshape(-1, 3)
+        inside = numpy.zeros(len(points), bool)
+
+        for start in range(0, len(points), QUERY_BLOCK):
+            block = points[start:start + QUERY_BLOCK]
+            directions = numpy.repeat(INSIDE_DIRECTION[None], len(block), 0)
+
+            crossings = self.ray_hits(block, directions, nearest=False)[2]
+            inside[start:start + len(block)] = crossings % 2 == 1
+
+        return inside
+
+    def box_distances(self, points, nodes):
+        # squared distance to the boxes, 0 inside
+        outside = numpy.maximum(self.lo[nodes] - points, 0) + numpy.maximum(points - self.hi[nodes], 0)
+        return (outside ** 2).sum(1)
+
+    def nearest_block(self, points):
+        q = len(points)
+        best = numpy.repeat(numpy.inf, q)
+        hits = numpy.repeat(-1, q)
+        closest = numpy.zeros((q, 3))
+
+        if not len(self.corners):
+            return closest, best, hits
+
+        def visit(query_i, tri_i):
+            found = closest_points(points[query_i], self.corners[tri_i])
+            distances = ((found - points[query_i]) ** 2).sum(1)
+
+            numpy.minimum.at(best, query_i, distances)
+            better = distances == best[query_i]
+            hits[query_i[better]] = tri_i[better]
+            closest[query_i[better]] = found[better]
+
+        # a first guess from the leaf down the closer side gives a bound to prune with
+        nodes = numpy.zeros(q, numpy.int64)
+        inner = self.count[nodes] == 0
+
+        while inner.any():
+            children = self.first[nodes[inner], None] + numpy.arange(2)
+            left, right = (self.box_distances(points[inner], children[:, side]) for side in range(2))
+            nodes[inner] = numpy.where(left <= right, children[:, 0], children[:, 1])
+            inner = self.count[nodes] == 0
+
+        visit(*self.leaf_triangles(numpy.arange(q), nodes)[0])
+
+        queries = numpy.arange(q)
+        nodes = numpy.zeros(q, numpy.int64)
+
+        while len(queries):
+            alive = self.box_distances(points[queries], nodes) <= best[queries]
+            (query_i, tri_i), (queries, nodes) = self.leaf_triangles(queries[alive], nodes[alive])
+            visit(query_i, tri_i)
+
+        return closest, numpy.sqrt(best), hits
+
+    def nearest(self, points):
+        # the closest point on the surface for every point, its distance and
+        # the index of the triangle it is on
+        points = numpy.asarray(points, numpy.float64).reshape(-1, 3)
+
+        closest = numpy.zeros((len(points), 3))
+        distances = numpy.repeat(numpy.inf, len(points))
+        triangles = numpy.repeat(-1, len(points))
+
+        for start in range(0, len(points), QUERY_BLOCK):
+            block = slice(start, start + QUERY_BLOCK)
+            found, best, hits = self.nearest_block(points[block])
+
+            closest[block] = found
+            distances[block] = best
+            triangles[block] = self.given_triangles(hits)
+
+        return closest, distances, triangles
+
+def triangle_hash(corners):
+    return hashlib.sha1(numpy.ascontiguousarray(corners, numpy.float64).tostring()).hexdigest()
+
+def mesh_bvh(obj, file_name=None):
+    # the tree of an ObjObject, kept next to its file and rebuilt when the
+    # triangles do not match anymore
+    corners = obj.vertex_array[obj.triangle_indices()]
+    content = triangle_hash(corners)
+
+    if file_name == None:
+        file_name = obj.file_name + '.bvh.npz'
+
+    if os.path.exists(file_name):
+        try:
+            if str(numpy.load(file_name)['content']) == content:
+                return BVH.load(file_name, corners)
+        except (IOError, ValueError, KeyError):
+            pass
+
+    tree = BVH.build(corners)
+
+    try:
+        tree.save(file_name, content=content)
+    except IOError:
+        pass
+
+    return tree
+
+def main(argv):
+    import obj_parser
+
+    if len(argv) < 1:
+        print "Please specify an .obj file"
+        return 1
+
+    obj = obj_parser.ObjObject(argv[0])
+
+    start = time.time()
+    tree = mesh_bvh(obj)
+
+    print "%i triangles, %i nodes, %i leaves in %.2fs" % (len(tree.corners),
+            len(tree.count), (tree.count > 0).sum(), time.time() - start)
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main(sys.argv[1:]))
@@ -40,6 +40,9 @@ class Pipe:
     def gl_init(self):
         self.handle.gl_init()
 
+        self.handles = ucgf.InstancedMesh(self.handle)
+        self.handles.gl_init()
+
     def next_point(self, forward=True):
         delta = 1 if forward else -1
         self.cur = (self.cur + delta) % len(self.points)
@@ -69,25 +72,24 @@ class Pipe:
                 self.points[self.cur] += ucgf.Vector(move) * runtime
 
     def render(self):
-        handle = self.handle
         cur = self.cur
         points = self.points
 
         # drawing the handles for the pipe
         factor = 0.2
-        for index, point in enumerate(points):
-            glPushMatrix()
+        transforms = []
+        colors = []
 
+        for index, point in enumerate(points):
             if index == cur: 
-                glColor(1, 0, 0, 1)
+                colors.append((1, 0, 0, 1))
             else:
-                glColor(0.5, 0.2, 0.2, 1)
+                colors.append((0.5, 0.2, 0.2, 1))
 
-            glTranslate(point[0], point[1], 0)
-            glScale(factor, factor, factor)
-            handle.render()
+            transforms.append(ucgf.translation(point[0], point[1], 0)
+                    .dot(ucgf.scaling(factor, factor, factor)))
 
-            glPopMatrix()
+        self.handles.render(transforms, colors)
 
         # turning the light off for the lines
         glDisable(GL_LIGHTING)
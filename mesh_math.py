@@ -18,47 +18,392 @@
 ##
 ###############################################################################
 
-from pygame.locals import *
-from OpenGL.GL import *
-from OpenGL.GLU import *
+import os
+import sys
+import json
+import glob
+import tempfile
+import traceback
+import multiprocessing
+
+import numpy
+
+# obj_parser pulls in pygame, whose greeting would end up between the results
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
 
-import ucgf
 import obj_parser
 
-def face_surface(face):
-    if len(face) != 3:
+# bytes of the obj file read at once when streaming
+STREAM_BLOCK = 1 << 24
+
+# batch workers are replaced after this many files, and may not use more memory
+BATCH_TASKS = 16
+BATCH_MEMORY = 2 << 30
+
+def triangle_corners(vertices, vertex_indices, sizes):
+    # the corner positions of all faces, one row of three per triangle
+    if (sizes != 3).any():
+        raise NotImplementedError("Only triangles allowed")
+
+    if len(vertex_indices) and (vertex_indices.min() < 0 or vertex_indices.max() >= len(vertices)):
+        raise ValueError("Face refers to a missing vertex")
+
+    return numpy.asarray(vertices, numpy.float64)[vertex_indices].reshape(-1, 3, 3)
+
+def mesh_triangles(mesh):
+    if (mesh.face_sizes != 3).any():
         raise NotImplementedError("Only triangles allowed")
 
-    a = (face[1] - face[0]).size()
-    b = (face[2] - face[0]).size()
-    c = (face[1] - face[2]).size()
+    # faces and strips alike
+    indices = mesh.triangle_indices()
+    return triangle_corners(mesh.vertex_array, indices.ravel(), numpy.repeat(3, len(indices))), indices
 
-    s = (a + b + c) / 2.0
+def triangle_areas(corners):
+    a, b, c = corners[:, 0], corners[:, 1], corners[:, 2]
+    return numpy.sqrt((numpy.cross(b - a, c - a) ** 2).sum(1)) * 0.5
 
-    return (s * (s - a) * (s - b) * (s - c)) ** 0.5
+def signed_volumes(corners):
+    # of the tetrahedra between the origin and each triangle
+    a, b, c = corners[:, 0], corners[:, 1], corners[:, 2]
+    return (a * numpy.cross(b, c)).sum(1) / 6.0
 
 def surface(mesh):
-    return sum(face_surface(face) for face in mesh.vect_faces())
+    return triangle_areas(mesh_triangles(mesh)[0]).sum()
 
 def volume(mesh):
-    return 1.0 / 6 * sum(a * b.cross(c) for a, b, c in mesh.vect_faces())
+    return signed_volumes(mesh_triangles(mesh)[0]).sum()
 
-def main(argv):
-    actions = {
-            'surface': surface,
-            'volume': volume,
-            }
+def obj_blocks(file_name, block_size=STREAM_BLOCK):
+    # pieces of the file that end on a line break
+    f = obj_parser.open_obj(file_name)
+    rest = ''
+
+    try:
+        while True:
+            data = f.read(block_size)
+
+            if not data:
+                break
+
+            end = data.rfind('\n') + 1
+            if end:
+                yield rest + data[:end]
+                rest = data[end:]
+            else:
+                rest += data
+    finally:
+        f.close()
+
+    if rest.strip():
+        yield rest
+
+def stream_triangles(file_name, block_size=STREAM_BLOCK):
+    # the triangles of a file block by block with their vertex indices, only
+    # the vertices are kept and those in a temporary file on disk
+    store = tempfile.TemporaryFile()
+    count = 0
+
+    try:
+        for data in obj_blocks(file_name, block_size):
+            chunk = obj_parser.parse_chunk(data)
+
+            store.seek(0, os.SEEK_END)
+            store.write(chunk['vertices'].tostring())
+            store.flush()
+
+            counts = chunk['counts'].copy()
+            counts[:, 0] += count
+            count += len(chunk['vertices'])
+
+            if not len(chunk['sizes']):
+                continue
+
+            indices = obj_parser.resolve_indices(chunk['corners'], chunk['sizes'], counts)[:, 0]
+
+            vertices = numpy.memmap(store, numpy.float32, 'r', shape=(count, 3))
+            yield triangle_corners(vertices, indices, chunk['sizes']), indices.reshape(-1, 3)
+            del vertices
+    finally:
+        store.close()
+
+def mesh_blocks(mesh):
+    yield mesh_triangles(mesh)
+
+def edge_keys(indices):
+    # both ends of the three edges of every triangle, and a key for each
+    # edge that is the same in either direction
+    start = indices.ravel().astype(numpy.int64)
+    end = indices[:, [1, 2, 0]].ravel().astype(numpy.int64)
+
+    return start, end, numpy.minimum(start, end) << 32 | numpy.maximum(start, end)
+
+# everything MeshProperties can measure, in the order it is printed
+METRICS = ['surface', 'volume', 'centroid', 'inertia', 'bounds', 'edges', 'watertight']
+
+class MeshProperties:
+
+    # collects the selected metrics over blocks of triangles, so a mesh is
+    # only gone through once however many of them are wanted
+
+    def __init__(self, metrics=METRICS):
+        unknown = set(metrics) - set(METRICS)
+        if unknown:
+            raise ValueError("Unknown metric: " + ", ".join(sorted(unknown)))
+
+        self.metrics = [metric for metric in METRICS if metric in metrics]
+
+        self.area = 0.0
+        self.volume = 0.0
+        # first and second moments of the tetrahedra to the origin
+        self.moment = numpy.zeros(3)
+        self.covariance = numpy.zeros((3, 3))
+
+        self.lo = numpy.repeat(numpy.inf, 3)
+        self.hi = numpy.repeat(-numpy.inf, 3)
+
+        # every edge is measured once, the keys of those seen so far are kept
+        self.seen_edges = numpy.zeros(0, numpy.int64)
+        self.edge_count = 0
+        self.edge_sum = 0.0
+        self.edge_squares = 0.0
+        self.edge_min = numpy.inf
+        self.edge_max = -numpy.inf
+
+        # edges still waiting for their opposite, as the sum of their directions
+        self.open_keys = numpy.zeros(0, numpy.int64)
+        self.open_sums = numpy.zeros(0, numpy.int64)
+        self.degenerate = False
+        self.triangles = 0
+
+    def wants(self, *metrics):
+        return any(metric in self.metrics for metric in metrics)
+
+    def add(self, corners, indices):
+        a, b, c = corners[:, 0], corners[:, 1], corners[:, 2]
+
+        if self.wants('surface'):
+            self.area += triangle_areas(corners).sum()
+
+        if self.wants('volume', 'centroid', 'inertia'):
+            volumes = signed_volumes(corners)
+            self.volume += volumes.sum()
+
+            if self.wants('centroid', 'inertia'):
+                self.moment += (volumes[:, None] * (a + b + c)).sum(0) / 4
+
+            if self.wants('inertia'):
+                # the integral of x x^T over a tetrahedron with a corner in the origin
+                s = a + b + c
+                outer = sum(numpy.einsum('ni,nj,n->ij', p, p, volumes) for p in (a, b, c, s))
+                self.covariance += outer / 20
+
+        if self.wants('bounds') and len(corners):
+            self.lo = numpy.minimum(self.lo, corners.min((0, 1)))
+            self.hi = numpy.maximum(self.hi, corners.max((0, 1)))
+
+        if self.wants('edges'):
+            keys, first = numpy.unique(edge_keys(indices)[2], return_index=True)
+
+            seen = self.seen_edges
+            place = numpy.searchsorted(seen, keys)
+            new = numpy.ones(len(keys), bool)
+
+            if len(seen):
+                new = seen[numpy.minimum(place, len(seen) - 1)] != keys
+
+            self.seen_edges = numpy.insert(seen, place[new], keys[new])
+
+            lengths = numpy.sqrt(((corners[:, [1, 2, 0]] - corners) ** 2).sum(2)).ravel()[first[new]]
+
+            if len(lengths):
+                self.edge_count += len(lengths)
+                self.edge_sum += lengths.sum()
+                self.edge_squares += (lengths ** 2).sum()
+                self.edge_min = min(self.edge_min, lengths.min())
+                self.edge_max = max(self.edge_max, lengths.max())
+
+        if self.wants('watertight'):
+            self.add_edges(indices)
+
+    def add_edges(self, indices):
+        # an edge is closed once it was used the other way round as often, so
+        # only the open ones along the border of what was seen are kept
+        start, end, keys = edge_keys(indices)
+        self.triangles += len(indices)
 
+        if (start == end).any():
+            self.degenerate = True
+
+        keys, inverse = numpy.unique(numpy.concatenate((self.open_keys, keys)), return_inverse=True)
+
+        sums = numpy.bincount(inverse, numpy.concatenate((self.open_sums, numpy.sign(end - start))),
+                len(keys)).astype(numpy.int64)
+
+        self.open_keys = keys[sums != 0]
+        self.open_sums = sums[sums != 0]
+
+    def result(self):
+        values = {}
+
+        if self.wants('surface'):
+            values['surface'] = float(self.area)
+
+        if self.wants('volume'):
+            values['volume'] = float(self.volume)
+
+        # only solids have a center of mass
+        centroid = self.moment / self.volume if self.volume else None
+
+        if self.wants('centroid'):
+            values['centroid'] = centroid if centroid is None else centroid.tolist()
+
+        if self.wants('inertia'):
+            if centroid is None:
+                values['inertia'] = None
+            else:
+                # unit density, around the centroid
+                covariance = self.covariance - self.volume * numpy.outer(centroid, centroid)
+                values['inertia'] = (numpy.trace(covariance) * numpy.eye(3) - covariance).tolist()
+
+        if self.wants('bounds'):
+            values['bounds'] = [self.lo.tolist(), self.hi.tolist()] if self.lo[0] <= self.hi[0] else None
+
+        if self.wants('edges'):
+            if self.edge_count:
+                mean = self.edge_sum / self.edge_count
+                deviation = max(self.edge_squares / self.edge_count - mean ** 2, 0) ** 0.5
+
+                values['edges'] = {'count': self.edge_count, 'min': float(self.edge_min),
+                        'max': float(self.edge_max), 'mean': float(mean), 'std': float(deviation)}
+            else:
+                values['edges'] = None
+
+        if self.wants('watertight'):
+            # nothing at all does not enclose anything either
+            values['watertight'] = self.triangles > 0 and not len(self.open_keys) and not self.degenerate
+
+        return values
+
+def mesh_properties(blocks, metrics=METRICS):
+    properties = MeshProperties(metrics)
+
+    for corners, indices in blocks:
+        properties.add(corners, indices)
+
+    return properties.result()
+
+def batch_files(pattern):
+    # all obj files below a directory or the files matching a glob
+    if not os.path.isdir(pattern):
+        return sorted(glob.glob(pattern))
+
+    found = []
+
+    for root, dirs, files in os.walk(pattern):
+        dirs.sort()
+        found.extend(os.path.join(root, name) for name in sorted(files)
+                if name.endswith('.obj') or name.endswith('.obj.gz'))
+
+    return found
+
+def limit_memory(size):
+    import resource
+
+    # the hard limit can not be raised, only stay below it
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        size = min(size, hard)
+
+    resource.setrlimit(resource.RLIMIT_AS, (size, hard))
+
+def measure_file(task):
+    file_name, metrics, stream = task
+
+    try:
+        if stream:
+            blocks = stream_triangles(file_name)
+        else:
+            blocks = mesh_blocks(obj_parser.ObjObject(file_name, cache=False))
+
+        values = mesh_properties(blocks, metrics)
+    except MemoryError:
+        values = {'error': "MemoryError: out of memory"}
+    except Exception as e:
+        traceback.print_exc()
+        values = {'error': "%s: %s" % (type(e).__name__, e)}
+
+    values['file'] = file_name
+
+    return values
+
+def batch(pattern, metrics=METRICS, stream=False, processes=None, memory=BATCH_MEMORY, out=sys.stdout):
+    # measures many files at once, writing a json line for each as soon as it
+    # is done. returns the number of files that failed
+    tasks = [(file_name, metrics, stream) for file_name in batch_files(pattern)]
+    failed = 0
+
+    # a typo in the metrics would otherwise fail every single file
+    MeshProperties(metrics)
+
+    if not tasks:
+        return failed
+
+    pool = multiprocessing.Pool(processes, limit_memory, (memory,), BATCH_TASKS)
+
+    try:
+        for values in pool.imap_unordered(measure_file, tasks):
+            failed += 'error' in values
+
+            out.write(json.dumps(values, sort_keys=True) + '\n')
+            out.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    return failed
+
+def main(argv):
     if len(argv) < 1:
         print "Please specify an .obj file"
         return 1
 
-    obj = obj_parser.ObjObject(argv[0])
+    # batch runs go over a directory or glob, options like jobs:4 or memory:512 (MB)
+    if argv[0] == 'batch':
+        if len(argv) < 2:
+            print "Please specify a directory or pattern of .obj files"
+            return 1
+
+        options = dict(option.split(':', 1) for option in argv[2:] if ':' in option)
+        argv = argv[1:2] + [option for option in argv[2:] if ':' not in option]
+    else:
+        options = None
+
+    stream = 'stream' in argv[1:]
+    metrics = [option for option in argv[1:] if option != 'stream'] or METRICS
+
+    unknown = [metric for metric in metrics if metric not in METRICS]
+    if unknown:
+        print "Unknown metric: %s, choose from %s" % (", ".join(unknown), ", ".join(METRICS))
+        return 1
 
-    for action, fun in actions.items():
-        print "%s: %s" % (action, fun(obj))
+    if options != None:
+        processes = options.get('jobs') and int(options['jobs'])
+        memory = int(options.get('memory', BATCH_MEMORY >> 20)) << 20
+
+        return 1 if batch(argv[0], metrics, stream, processes, memory) else 0
+
+    # the mesh does not have to fit into memory when streaming
+    if stream:
+        blocks = stream_triangles(argv[0])
+    else:
+        blocks = mesh_blocks(obj_parser.ObjObject(argv[0]))
+
+    values = mesh_properties(blocks, metrics)
+
+    for metric in METRICS:
+        if metric in values:
+            print "%s: %s" % (metric, values[metric])
 
 if __name__ == "__main__":
     import sys
     sys.exit(main(sys.argv[1:]))
-
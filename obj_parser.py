@@ -18,9 +18,23 @@
 ##
 ###############################################################################
 
+import os
+import json
+import shutil
+import gzip
+import hashlib
+import tempfile
+import multiprocessing
 from warnings import warn
 from random import Random
 
+import numpy
+
+try:
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
 from pygame.locals import *
 from OpenGL.GL import *
 from OpenGL.GLU import *
@@ -28,43 +42,1016 @@ from OpenGL.GLU import *
 import ucgf
 from ucgf import Vector
 
-def in_triangle(point, triangle):
-    a, b, c = triangle
-    p = point
+def token_layout(text, lines):
+    # the number of tokens on each line and the number of slashes in each token
+    buf = numpy.frombuffer(text, numpy.uint8)
+
+    space = buf <= 32
+    starts = numpy.flatnonzero(~space & numpy.concatenate(([True], space[:-1])))
+    newlines = numpy.flatnonzero(buf == 10)
+    slashes = numpy.flatnonzero(buf == 47)
+
+    counts = numpy.diff(numpy.concatenate(([0], numpy.searchsorted(starts, newlines))))
+    slash_counts = numpy.diff(numpy.concatenate((numpy.searchsorted(slashes, starts), [len(slashes)])))
+
+    return counts[:lines], slash_counts
+
+def to_rows(values, counts, width):
+    # spread a flat run of values into rows of the given lengths
+    if (counts == width).all():
+        return values.reshape(-1, width)
+
+    rows = numpy.zeros((len(counts), width), values.dtype)
+    offsets = numpy.cumsum(counts) - counts
+    row = numpy.repeat(numpy.arange(len(counts)), counts)
+    col = numpy.arange(len(values)) - numpy.repeat(offsets, counts)
+
+    keep = col < width
+    rows[row[keep], col[keep]] = values[keep]
+
+    return rows
+
+def parse_floats(text, lines, width, least=1):
+    if not lines:
+        return numpy.zeros((0, width), numpy.float32)
+
+    values = numpy.fromstring(text, numpy.float64, sep=' ')
+
+    # with at least as many numbers per line as needed this can only mean one thing
+    if least >= width and len(values) == lines * width:
+        return values.reshape(-1, width).astype(numpy.float32)
+
+    counts = token_layout(text, lines)[0]
+
+    if len(values) != counts.sum():
+        raise ValueError("Malformed numbers in obj file")
+
+    return to_rows(values, counts, width).astype(numpy.float32)
+
+def parse_faces(text, lines):
+    if not lines:
+        return numpy.zeros((0, 3), numpy.int64), numpy.zeros(0, numpy.int32)
+
+    buf = numpy.frombuffer(text, numpy.uint8).copy()
+
+    sizes = token_layout(text, lines)[0]
+    corners = sizes.sum()
+    slashes = numpy.count_nonzero(buf == 47)
+
+    # with only triangles, each corner with up to two slashes, the totals
+    # already tell when all of them look the same
+    if (sizes == 3).all() and (slashes == 0 or slashes == corners * 2):
+        doubles = text.count('//')
+
+        if slashes == 0:
+            columns = [0]
+        elif doubles == corners:
+            columns = [0, 2]
+        elif doubles == 0:
+            columns = [0, 1, 2]
+        else:
+            columns = None
+
+        if columns:
+            buf[buf == 47] = 32
+            values = numpy.fromstring(buf.tostring(), numpy.int64, sep=' ')
+
+            if len(values) != corners * len(columns):
+                raise ValueError("Malformed faces in obj file")
+
+            rows = numpy.zeros((corners, 3), numpy.int64)
+            rows[:, columns] = values.reshape(-1, len(columns))
+
+            return rows, numpy.repeat(numpy.int32(3), lines)
+
+    # missing indices are read as 0, which obj never uses as an index
+    text = text.replace('//', '/0/')
+    sizes, slashes = token_layout(text, lines)
+    values = numpy.fromstring(text.replace('/', ' '), numpy.int64, sep=' ')
+
+    if len(values) != (slashes + 1).sum():
+        raise ValueError("Malformed faces in obj file")
+
+    return to_rows(values, slashes + 1, 3), sizes.astype(numpy.int32)
+
+def resolve_indices(corners, sizes, counts):
+    # obj counts from 1, negative indices are relative to the elements so far
+    resolved = corners - 1
+    relative = corners < 0
+
+    if relative.any():
+        per_corner = numpy.repeat(counts, sizes, axis=0)
+        resolved[relative] = (per_corner + corners)[relative]
+
+    resolved[corners == 0] = -1
+
+    return resolved.astype(numpy.int32)
+
+# kinds of lines in an obj file
+SKIP, VERTEX, TEXTURE, NORMAL, FACE, OTHER = range(6)
+
+def parse_chunk(data):
+    # everything of a piece of an obj file that does not depend on the rest
+    if not data.endswith('\n'):
+        data += '\n'
+
+    # padded, so that peeking at the first three characters of a line is safe
+    buf = numpy.frombuffer(data + '\n\n', numpy.uint8).copy()
+
+    ends = numpy.flatnonzero(buf[:len(data)] == 10)
+    starts = numpy.concatenate(([0], ends[:-1] + 1))
+    first, second, third = (buf[starts + i] for i in range(3))
 
-    v0 = c - a
-    v1 = b - a
-    v2 = p - a
+    # indented lines are rare, just get rid of the indentation and start over
+    indented = numpy.flatnonzero((first == 32) | (first == 9))
+    if any(data[starts[i]:ends[i]].strip() for i in indented):
+        return parse_chunk('\n'.join(line.strip() for line in data.splitlines()))
 
-    dot00 = v0 * v0
-    dot01 = v0 * v1
-    dot02 = v0 * v2
-    dot11 = v1 * v1
-    dot12 = v1 * v2
+    kinds = numpy.empty(len(starts), numpy.uint8)
+    kinds[:] = OTHER
+    kinds[(first <= 32) | (first == ord('#'))] = SKIP
+    kinds[(first == ord('v')) & (second <= 32)] = VERTEX
+    kinds[(first == ord('v')) & (second == ord('t')) & (third <= 32)] = TEXTURE
+    kinds[(first == ord('v')) & (second == ord('n')) & (third <= 32)] = NORMAL
+    kinds[(first == ord('f')) & (second <= 32)] = FACE
 
-    denom = (dot00 * dot11 - dot01 * dot01)
+    unknown = set(data[starts[i]:ends[i]].split()[0]
+            for i in numpy.flatnonzero(kinds == OTHER))
 
-    if denom:
-        u = (dot11 * dot02 - dot01 * dot12) / denom
-        v = (dot00 * dot12 - dot01 * dot02) / denom
+    # blank out the commands, only the numbers are left then
+    for kind, width in (VERTEX, 1), (TEXTURE, 2), (NORMAL, 2), (FACE, 1):
+        for i in range(width):
+            buf[starts[kinds == kind] + i] = 32
 
-        e = p - (u * v0 + v * v1)
+    buf = buf[:len(data)]
 
-        diff = sum(e)
+    # lines of the same kind usually come in long runs, cut those out directly
+    changes = numpy.flatnonzero(kinds[1:] != kinds[:-1]) + 1
+    run_starts = numpy.concatenate(([0], changes))
+    run_ends = numpy.concatenate((changes, [len(kinds)]))
 
-        return u > 0 and v > 0 and u + v < 1 and diff < 10**-10
+    if len(run_starts) < 10000:
+        text = buf.tostring()
+        runs = zip(kinds[run_starts], starts[run_starts], ends[run_ends - 1] + 1)
+
+        def block(kind):
+            parts = [text[start:end] for run_kind, start, end in runs if run_kind == kind]
+            return ''.join(parts), (kinds == kind).sum()
     else:
-        return False
+        byte_kinds = numpy.repeat(kinds, ends - starts + 1)
+
+        def block(kind):
+            return buf[byte_kinds == kind].tostring(), (kinds == kind).sum()
+
+    texture_text, texture_lines = block(TEXTURE)
+    # some files mix two and three coordinates, the widest line decides
+    texture_width = token_layout(texture_text, texture_lines)[0].max() if texture_lines else 2
+
+    # what was there before each face, for the relative indices
+    counts = numpy.column_stack([numpy.cumsum(kinds == kind)[kinds == FACE]
+        for kind in (VERTEX, TEXTURE, NORMAL)])
+
+    corners, sizes = parse_faces(*block(FACE))
+
+    return {
+            'vertices': parse_floats(*(block(VERTEX) + (3, 3))),
+            'texture': parse_floats(texture_text, texture_lines, texture_width),
+            'normals': parse_floats(*(block(NORMAL) + (3, 3))),
+            'corners': corners,
+            'sizes': sizes,
+            'counts': counts,
+            'unknown': unknown,
+            }
+
+def merge_chunks(chunks):
+    # indices are global, so the relative ones need what came before the chunk
+    before = numpy.zeros(3, numpy.int64)
+    counts = []
+
+    for chunk in chunks:
+        counts.append(chunk['counts'] + before)
+        before += [len(chunk[name]) for name in ('vertices', 'texture', 'normals')]
+
+    for cmd in sorted(set().union(*(chunk['unknown'] for chunk in chunks))):
+        warn("Unknown command: " + cmd)
+
+    # chunks without texture coordinates do not know their width
+    width = max(chunk['texture'].shape[1] for chunk in chunks)
+    texture = [to_rows(chunk['texture'].ravel(), numpy.repeat(chunk['texture'].shape[1],
+        len(chunk['texture'])), width) for chunk in chunks]
+
+    def join(name):
+        return numpy.concatenate([chunk[name] for chunk in chunks])
+
+    sizes = join('sizes')
+
+    return {
+            'vertices': join('vertices'),
+            'texture': numpy.concatenate(texture),
+            'normals': join('normals'),
+            'corners': resolve_indices(join('corners'), sizes, numpy.concatenate(counts)),
+            'sizes': sizes,
+            }
+
+def parse_obj(data):
+    return merge_chunks([parse_chunk(data)])
+
+def chunk_ranges(file_name, pieces):
+    # byte ranges of about the same size, each ending after a newline
+    size = os.path.getsize(file_name)
+    bounds = [0]
+
+    with open(file_name, 'rb') as f:
+        for i in range(1, pieces):
+            f.seek(max(size * i // pieces, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+
+    bounds.append(size)
+
+    return [(file_name, start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+def parse_range(piece):
+    file_name, start, end = piece
+
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        return parse_chunk(f.read(end - start))
+
+# smaller files are not worth starting processes for
+PARALLEL_SIZE = 1 << 24
+
+def parse_obj_file(file_name, processes=1):
+    if processes == None:
+        processes = multiprocessing.cpu_count()
+
+    # compressed files can not be split, they are read in one go
+    if processes <= 1 or os.path.getsize(file_name) < PARALLEL_SIZE or file_name.endswith('.gz'):
+        return parse_obj(open_obj(file_name).read())
+
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        chunks = pool.map(parse_range, chunk_ranges(file_name, processes))
+    finally:
+        pool.close()
+        pool.join()
+
+    return merge_chunks(chunks)
+
+class MeshCache:
+
+    # compiled meshes as .npy files, memory mapped on the next load
+
+    VERSION = 1
+    ARRAYS = ('vertices', 'texture', 'normals', 'corners', 'sizes')
+
+    def __init__(self, dir_name=None, max_size=1 << 30):
+        if dir_name == None:
+            dir_name = os.environ.get('UCGF_CACHE',
+                    os.path.join(os.path.expanduser('~'), '.cache', 'ucgf'))
+
+        self.dir_name = dir_name
+        self.max_size = max_size
+
+    def entry(self, file_name):
+        key = hashlib.sha1(os.path.abspath(file_name)).hexdigest()
+        return os.path.join(self.dir_name, key)
+
+    def load(self, file_name):
+        entry = self.entry(file_name)
+        meta_name = os.path.join(entry, 'meta.json')
+
+        try:
+            meta = json.load(open(meta_name))
+        except (IOError, ValueError):
+            return None
+
+        stat = os.stat(file_name)
+
+        if meta['version'] != self.VERSION or meta['path'] != os.path.abspath(file_name):
+            return None
+
+        if meta['size'] != stat.st_size:
+            return None
+
+        # a new timestamp alone does not mean new content
+        if meta['mtime'] != stat.st_mtime:
+            if file_hash(open(file_name, 'rb').read()) != meta['hash']:
+                return None
+
+            meta['mtime'] = stat.st_mtime
+            write_json(meta_name, meta)
+
+        try:
+            mesh = dict((name, numpy.load(os.path.join(entry, name + '.npy'), mmap_mode='c'))
+                    for name in self.ARRAYS)
+        except (IOError, ValueError):
+            return None
+
+        # keeps track of the last use for the eviction
+        os.utime(entry, None)
+
+        return mesh
+
+    def store(self, file_name, mesh, content_hash):
+        stat = os.stat(file_name)
+
+        meta = {
+                'version': self.VERSION,
+                'path': os.path.abspath(file_name),
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'hash': content_hash,
+                }
+
+        if not os.path.isdir(self.dir_name):
+            os.makedirs(self.dir_name)
+
+        # written next to the cache and moved in place when complete
+        tmp = tempfile.mkdtemp(dir=self.dir_name, prefix='.tmp-')
+
+        try:
+            for name in self.ARRAYS:
+                numpy.save(os.path.join(tmp, name + '.npy'), mesh[name])
+
+            write_json(os.path.join(tmp, 'meta.json'), meta)
+
+            entry = self.entry(file_name)
+
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+
+            os.rename(tmp, entry)
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+
+        for name in os.listdir(self.dir_name):
+            entry = os.path.join(self.dir_name, name)
+
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+
+            size = sum(os.path.getsize(os.path.join(entry, part)) for part in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+
+        total = sum(size for used, size, entry in entries)
+
+        # least recently used first
+        for used, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+def file_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+def write_json(file_name, data):
+    out = open(file_name, 'w')
+    json.dump(data, out)
+    out.close()
+
+# the cache used by ObjObject unless told otherwise
+mesh_cache = MeshCache()
+
+def load_mesh(file_name, cache=True, processes=1):
+    if cache is True:
+        cache = mesh_cache
+
+    if cache:
+        mesh = cache.load(file_name)
+
+        if mesh != None:
+            return mesh
+
+    mesh = parse_obj_file(file_name, processes)
+
+    if cache:
+        try:
+            cache.store(file_name, mesh, file_hash(open(file_name, 'rb').read()))
+        except (IOError, OSError), e:
+            warn("Could not cache %s: %s" % (file_name, e))
+
+    return mesh
+
+def corner_lists(corners, sizes):
+    # lists of (v, vt, vn) tuples, counting from 1 and None if missing
+    corners = [tuple(i or None for i in corner) for corner in (corners + 1).tolist()]
+    ends = numpy.cumsum(sizes).tolist()
+    starts = [0] + ends[:-1]
+
+    return [corners[start:end] for start, end in zip(starts, ends)]
+
+def corner_arrays(polygons):
+    corners = [[i - 1 if i else -1 for i in corner] for polygon in polygons for corner in polygon]
+    return corners, [len(polygon) for polygon in polygons]
+
+def face_offsets(sizes):
+    return numpy.cumsum(sizes) - sizes
+
+def compressed_rows(source, target, count):
+    # the targets of each source in one array, rows start at the offsets
+    width = max(count, target.max() + 1 if len(target) else 0)
+    keys = numpy.unique(source.astype(numpy.int64) * width + target)
+    source, target = keys // width, keys % width
+
+    offsets = numpy.zeros(count + 1, numpy.int32)
+    offsets[1:] = numpy.cumsum(numpy.bincount(source, minlength=count))
+
+    return offsets, target.astype(numpy.int32)
+
+def following_corners(sizes):
+    # the index of the next corner around the face for every corner
+    following = numpy.arange(1, sizes.sum() + 1)
+    ends = numpy.cumsum(sizes)[sizes > 0] - 1
+    following[ends] = face_offsets(sizes)[sizes > 0]
+
+    return following
+
+def adjacency(vertex_indices, sizes, count):
+    # every corner is connected to the following one in its face, both ways
+    following = following_corners(sizes)
+
+    source = numpy.concatenate((vertex_indices, vertex_indices[following]))
+    target = numpy.concatenate((vertex_indices[following], vertex_indices))
+    edges = source != target
+
+    return compressed_rows(source[edges], target[edges], count)
+
+def incidence(vertex_indices, sizes, count):
+    faces = numpy.repeat(numpy.arange(len(sizes)), sizes)
+    return compressed_rows(vertex_indices, faces, count)
+
+# rows formatted per write, keeps the text in memory bounded
+WRITE_BLOCK = 1 << 16
+
+def write_rows(out, name, rows):
+    if not len(rows):
+        return
+
+    # nine significant digits give back the same float32
+    line = name + ' %.9g' * rows.shape[1] + '\n'
+
+    for start in range(0, len(rows), WRITE_BLOCK):
+        block = rows[start:start + WRITE_BLOCK]
+        out.write(line * len(block) % tuple(block.ravel().tolist()))
+
+# how a corner is written, by which of texture and normal index it has
+CORNER_FORMATS = ['%d', '%d/%d', '%d//%d', '%d/%d/%d']
+CORNER_COLUMNS = [[0], [0, 1], [0, 2], [0, 1, 2]]
+
+def face_text(corners, sizes):
+    present = corners[:, 1:] >= 0
+    patterns = present[:, 0] + 2 * present[:, 1]
+
+    # usually all faces look the same and one format string does it
+    if (sizes == sizes[0]).all() and (patterns == patterns[0]).all():
+        pattern = patterns[0]
+        line = 'f' + (' ' + CORNER_FORMATS[pattern]) * sizes[0] + '\n'
+        return line * len(sizes) % tuple((corners[:, CORNER_COLUMNS[pattern]] + 1).ravel().tolist())
+
+    tokens = numpy.empty(len(corners), object)
+
+    for pattern in numpy.unique(patterns):
+        chosen = numpy.flatnonzero(patterns == pattern)
+        values = corners[chosen][:, CORNER_COLUMNS[pattern]] + 1
+        text = (CORNER_FORMATS[pattern] + '\n') * len(chosen) % tuple(values.ravel().tolist())
+        tokens[chosen] = text.split('\n')[:-1]
+
+    separators = numpy.empty(len(corners), object)
+    separators[:] = ' '
+    separators[face_offsets(sizes)] = '\nf '
+
+    parts = numpy.empty(len(corners) * 2, object)
+    parts[0::2] = separators
+    parts[1::2] = tokens
+
+    return ''.join(parts.tolist())[1:] + '\n'
+
+def write_faces(out, corners, sizes):
+    offsets = face_offsets(sizes)
+
+    for start in range(0, len(sizes), WRITE_BLOCK):
+        block_sizes = sizes[start:start + WRITE_BLOCK]
+        first = offsets[start]
+        out.write(face_text(corners[first:first + block_sizes.sum()], block_sizes))
+
+def open_obj(file_name, mode='rb'):
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, mode, 6)
+    else:
+        return open(file_name, mode)
+
+def face_normals(vertices, vertex_indices, sizes):
+    # newell's method, also good for faces that are not convex or planar
+    points = vertices[vertex_indices] - numpy.repeat(vertices[vertex_indices[face_offsets(sizes)]], sizes, 0)
+    crossed = numpy.cross(points, points[following_corners(sizes)])
+    faces = numpy.repeat(numpy.arange(len(sizes)), sizes)
+
+    return numpy.column_stack([numpy.bincount(faces, crossed[:, axis], len(sizes))
+        for axis in range(3)])
 
-def face_item(l):
-    raw = [int(i) if i else None for i in l.split('/')]
-    return tuple(raw + [None] * (3 - len(raw)))
+def ear_clip(points):
+    # ear clipping on a doubly linked ring of the (x, y) points. only reflex
+    # vertices can be in the way of an ear, they are kept in a grid for the tests
+    n = len(points)
+    xs = [float(x) for x, y in points]
+    ys = [float(y) for x, y in points]
 
-def face_str(face):
-    if any(face[1:]):
-        return '/'.join(str(i) if i else "" for i in face)
+    # counter clockwise from here on
+    if sum(xs[i - 1] * ys[i] - xs[i] * ys[i - 1] for i in range(n)) < 0:
+        ys = [-y for y in ys]
+
+    prev = [n - 1] + range(n - 1)
+    foll = range(1, n) + [0]
+
+    def turn(i):
+        a, c = prev[i], foll[i]
+        return (xs[i] - xs[a]) * (ys[c] - ys[i]) - (ys[i] - ys[a]) * (xs[c] - xs[i])
+
+    # points on a straight line are counted in, they can still be in the way
+    reflex = set(i for i in range(n) if turn(i) <= 0)
+
+    left, bottom = min(xs), min(ys)
+    cell_size = max(max(xs) - left, max(ys) - bottom) / max(len(reflex) ** 0.5, 1) or 1.
+
+    def cell(x, y):
+        return int((x - left) / cell_size), int((y - bottom) / cell_size)
+
+    grid = {}
+    for i in reflex:
+        grid.setdefault(cell(xs[i], ys[i]), set()).add(i)
+
+    # what was in the way of an ear the last time, usually still is
+    blockers = {}
+
+    def is_ear(i):
+        if turn(i) <= 0:
+            return False
+
+        a, c = prev[i], foll[i]
+        ax, ay, bx, by, cx, cy = xs[a], ys[a], xs[i], ys[i], xs[c], ys[c]
+
+        def in_the_way(j):
+            px, py = xs[j], ys[j]
+
+            inside = min((bx - ax) * (py - ay) - (by - ay) * (px - ax),
+                    (cx - bx) * (py - by) - (cy - by) * (px - bx),
+                    (ax - cx) * (py - cy) - (ay - cy) * (px - cx))
+
+            # reflex points on the edges are in the way too, points on a straight
+            # line and duplicates of the corners, e.g. where holes were bridged, not
+            return inside > 0 or (inside == 0 and turn(j) < 0 and
+                    (px, py) != (ax, ay) and (px, py) != (cx, cy))
+
+        blocker = blockers.get(i)
+        if blocker in reflex and in_the_way(blocker):
+            return False
+
+        low_x, low_y = cell(min(ax, bx, cx), min(ay, by, cy))
+        high_x, high_y = cell(max(ax, bx, cx), max(ay, by, cy))
+
+        # big ears cover more cells than there are reflex vertices left
+        if (high_x - low_x + 1) * (high_y - low_y + 1) > len(reflex):
+            candidates = reflex
+        else:
+            candidates = [j for gx in range(low_x, high_x + 1) for gy in range(low_y, high_y + 1)
+                    for j in grid.get((gx, gy), ())]
+
+        for j in candidates:
+            if in_the_way(j):
+                blockers[i] = j
+                return False
+
+        return True
+
+    triangles = []
+    i = 0
+    remaining = n
+    stalled = 0
+
+    while remaining > 3:
+        # without any ear left the polygon is not simple, cut one off anyway
+        if is_ear(i) or stalled > remaining:
+            a, c = prev[i], foll[i]
+            triangles.append((a, i, c))
+
+            foll[a] = c
+            prev[c] = a
+            remaining -= 1
+            stalled = 0
+
+            if i in reflex:
+                reflex.discard(i)
+                grid[cell(xs[i], ys[i])].discard(i)
+
+            # cutting off an ear only ever makes its neighbors convex
+            for j in a, c:
+                if j in reflex and turn(j) > 0:
+                    reflex.discard(j)
+                    grid[cell(xs[j], ys[j])].discard(j)
+
+            i = c
+        else:
+            i = foll[i]
+            stalled += 1
+
+    triangles.append((prev[i], i, foll[i]))
+
+    return triangles
+
+def triangulate_faces(vertices, vertex_indices, sizes):
+    # the triangles as indices of the corners, in the order of the faces
+    starts = face_offsets(sizes)
+    faces = []
+    triangles = []
+
+    chosen = numpy.flatnonzero(sizes == 3)
+    faces.append(chosen)
+    triangles.append(starts[chosen, None] + numpy.arange(3))
+
+    # quads are common enough, split them along the diagonal that keeps
+    # both halves facing the same way as the quad
+    chosen = numpy.flatnonzero(sizes == 4)
+    corners = starts[chosen, None] + numpy.arange(4)
+    points = vertices[vertex_indices[corners]]
+    normals = face_normals(vertices, vertex_indices[corners.ravel()], sizes[chosen])
+
+    def facing(i, j, k):
+        crossed = numpy.cross(points[:, j] - points[:, i], points[:, k] - points[:, i])
+        return (crossed * normals).sum(1) > 0
+
+    split = facing(0, 1, 2) & facing(0, 2, 3)
+
+    faces.append(numpy.repeat(chosen, 2))
+    triangles.append(starts[chosen, None] + numpy.where(split[:, None],
+        [0, 1, 2, 0, 2, 3], [1, 2, 3, 1, 3, 0]))
+
+    # anything bigger is clipped in the plane it is facing the most
+    for face in numpy.flatnonzero(sizes > 4):
+        corners = numpy.arange(starts[face], starts[face] + sizes[face])
+        normal = face_normals(vertices, vertex_indices[corners], sizes[face:face + 1])[0]
+        plane = numpy.delete(numpy.arange(3), numpy.abs(normal).argmax())
+
+        faces.append(numpy.repeat(face, sizes[face] - 2))
+        # a short list of triangles would be taken as a tuple of index arrays
+        ears = numpy.array(ear_clip(vertices[vertex_indices[corners]][:, plane]), numpy.int64)
+        triangles.append(corners[ears.reshape(-1, 3)])
+
+    order = numpy.argsort(numpy.concatenate(faces), kind='mergesort')
+
+    return numpy.concatenate([t.reshape(-1, 3) for t in triangles])[order]
+
+def polygon_triangles(sizes, strip_sizes):
+    # the triangles of the faces followed by those of the strips, as indices
+    # of their corners lined up the same way, with the polygon they belong to
+    starts = face_offsets(numpy.concatenate((sizes, strip_sizes)))
+
+    def runs(sizes):
+        counts = numpy.maximum(sizes - 2, 0)
+        polygon_i = numpy.repeat(numpy.arange(len(sizes)), counts)
+        step = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        return polygon_i, step
+
+    # fan out every face from its first corner
+    face_i, step = runs(sizes)
+    first = starts[face_i]
+    fans = numpy.column_stack((first, first + step + 1, first + step + 2))
+
+    # every second triangle of a strip is flipped to keep its winding
+    strip_i, step = runs(strip_sizes)
+    strip_i += len(sizes)
+    first = starts[strip_i] + step
+    odd = step % 2
+    strips = numpy.column_stack((first + odd, first + 1 - odd, first + 2))
+
+    return numpy.concatenate((fans, strips)), numpy.concatenate((face_i, strip_i)), starts
+
+def fan_triangles(vertex_indices, sizes):
+    # every face fanned out from its first corner
+    fans = numpy.maximum(sizes - 2, 0)
+    first = numpy.repeat(face_offsets(sizes), fans)
+    step = numpy.arange(fans.sum()) - numpy.repeat(numpy.cumsum(fans) - fans, fans)
+
+    return vertex_indices[numpy.column_stack((first, first + step + 1, first + step + 2))]
+
+def cotangent_weights(vertices, triangles, offsets, neighbors):
+    # half the cotangents of the angles opposite of each edge, looked up in
+    # the adjacency, the diagonals of fanned faces are not in there
+    count = len(offsets) - 1
+    rows = numpy.repeat(numpy.arange(count), numpy.diff(offsets))
+    keys = rows.astype(numpy.int64) * count + neighbors
+
+    weights = numpy.zeros(len(neighbors))
+
+    for k in range(3):
+        i, j, opposite = (triangles[:, (k + n) % 3] for n in (1, 2, 0))
+
+        a = vertices[i] - vertices[opposite]
+        b = vertices[j] - vertices[opposite]
+        area = numpy.sqrt((numpy.cross(a, b) ** 2).sum(1))
+        cot = (a * b).sum(1) / numpy.maximum(area, 1e-30) * 0.5
+
+        for source, target in (i, j), (j, i):
+            query = source.astype(numpy.int64) * count + target
+            found = numpy.minimum(numpy.searchsorted(keys, query), len(keys) - 1)
+            edge = keys[found] == query
+
+            weights += numpy.bincount(found[edge], cot[edge], len(weights))
+
+    # obtuse triangles give negative weights, which do not average
+    return numpy.maximum(weights, 0)
+
+def averaging(vertices, vertex_indices, sizes, offsets, neighbors, weights='uniform'):
+    # a function giving the weighted average over the neighbors of each vertex
+    count = len(offsets) - 1
+    counts = numpy.diff(offsets)
+    rows = numpy.repeat(numpy.arange(count), counts)
+
+    values = numpy.ones(len(neighbors))
+
+    if weights == 'cotangent':
+        cot = cotangent_weights(vertices, fan_triangles(vertex_indices, sizes), offsets, neighbors)
+
+        # fall back to uniform where no angle gave a usable weight
+        usable = numpy.bincount(rows, cot, count) > 0
+        values = numpy.where(usable[rows], cot, values)
+    elif weights != 'uniform':
+        raise ValueError("Unknown weights: " + weights)
+
+    values /= numpy.bincount(rows, values, count)[rows]
+
+    if scipy:
+        matrix = scipy.sparse.csr_matrix((values, neighbors, offsets), shape=(count, count))
+        return matrix.dot
+
+    def average(vertices):
+        return numpy.column_stack([numpy.bincount(rows, values * vertices[neighbors, axis], count)
+            for axis in range(vertices.shape[1])])
+
+    return average
+
+# pass band of the taubin smoothing, decides how far it steps back
+TAUBIN_PASS = 0.1
+
+def shared_edges(vertex_indices, sizes):
+    # the edges shared by exactly two faces, as the pairs of corners they
+    # start at, the edge of a corner goes to the following corner
+    count = vertex_indices.max() + 1 if len(vertex_indices) else 0
+    ends = vertex_indices[following_corners(sizes)]
+    keys = (numpy.minimum(vertex_indices, ends).astype(numpy.int64) * count +
+            numpy.maximum(vertex_indices, ends))
+
+    order = numpy.argsort(keys, kind='mergesort')
+    same = keys[order[1:]] == keys[order[:-1]]
+
+    pairs = same.copy()
+    pairs[1:] &= ~same[:-1]
+    pairs[:-1] &= ~same[1:]
+
+    return order[numpy.flatnonzero(pairs)], order[numpy.flatnonzero(pairs) + 1]
+
+def triangle_neighbors(triangles):
+    # the triangle across each edge (a, b), (b, c), (c, a) of every triangle,
+    # -1 at borders and where more than two triangles meet
+    first, second = shared_edges(triangles.ravel(), numpy.repeat(3, len(triangles)))
+
+    neighbors = numpy.repeat(-1, triangles.size)
+    neighbors[first] = second // 3
+    neighbors[second] = first // 3
+
+    return neighbors.reshape(-1, 3)
+
+def vertex_normals(vertices, vertex_indices, sizes, weighting='area', crease=None):
+    # a normal for every corner, averaged over the faces around its vertex
+    # that meet at less than the crease angle (in degrees). returns the
+    # normals and the index of the normal of each corner
+    vertices = vertices.astype(numpy.float64)
+    faces = numpy.repeat(numpy.arange(len(sizes)), sizes)
+    following = following_corners(sizes)
+
+    # newell normals are as long as twice the area
+    normals = face_normals(vertices, vertex_indices, sizes)
+    lengths = numpy.sqrt((normals ** 2).sum(1))
+    units = normals / numpy.maximum(lengths, 1e-30)[:, None]
+
+    if weighting == 'area':
+        weighted = normals[faces]
+    elif weighting == 'angle':
+        preceding = numpy.empty_like(following)
+        preceding[following] = numpy.arange(len(following))
+
+        points = vertices[vertex_indices]
+        a = points[preceding] - points
+        b = points[following] - points
+        angles = numpy.arctan2(numpy.sqrt((numpy.cross(a, b) ** 2).sum(1)), (a * b).sum(1))
+
+        weighted = units[faces] * angles[:, None]
+    else:
+        raise ValueError("Unknown weighting: " + weighting)
+
+    # corners share a normal when they are at the same vertex, or once there
+    # is a crease angle, when they are joined by smooth edges
+    if crease == None:
+        groups = vertex_indices.astype(numpy.int64)
     else:
-        return str(face[0])
+        first, second = shared_edges(vertex_indices, sizes)
+        smooth = (units[faces[first]] * units[faces[second]]).sum(1) > numpy.cos(numpy.radians(crease))
+        first, second = first[smooth], second[smooth]
+
+        # the edges run the other way round in the other face if both agree
+        # on the winding, but better not count on it
+        turned = vertex_indices[first] == vertex_indices[second]
+        left = numpy.concatenate((first, following[first]))
+        right = numpy.concatenate((numpy.where(turned, second, following[second]),
+            numpy.where(turned, following[second], second)))
+
+        groups = numpy.arange(len(vertex_indices))
+
+        while True:
+            lowest = numpy.minimum(groups[left], groups[right])
+            joined = groups.copy()
+            numpy.minimum.at(joined, left, lowest)
+            numpy.minimum.at(joined, right, lowest)
+            joined = joined[joined]
+
+            if (joined == groups).all():
+                break
+
+            groups = joined
+
+    groups, indices = numpy.unique(groups, return_inverse=True)
+
+    sums = numpy.zeros((len(groups), 3))
+    for axis in range(3):
+        sums[:, axis] = numpy.bincount(indices, weighted[:, axis], len(groups))
+
+    sums /= numpy.maximum(numpy.sqrt((sums ** 2).sum(1)), 1e-30)[:, None]
+
+    return sums.astype(numpy.float32), indices.astype(numpy.int32)
+
+def stripify(triangles):
+    # greedy triangle strips as lists of the triangles' corners. starts with
+    # the triangles with the fewest neighbors, which would end up alone later
+    neighbors = triangle_neighbors(triangles)
+    starts = numpy.argsort((neighbors >= 0).sum(1), kind='mergesort').tolist()
+
+    triangles = triangles.tolist()
+    neighbors = neighbors.tolist()
+    used = [False] * len(triangles)
+    strips = []
+
+    for start in starts:
+        if used[start]:
+            continue
+
+        used[start] = True
+        across = neighbors[start]
+
+        # leave through an edge with a free neighbor, if there is one
+        exit = 1
+        for k in 1, 2, 0:
+            if across[k] >= 0 and not used[across[k]]:
+                exit = k
+                break
+
+        corners = triangles[start]
+        strip = [corners[(exit + 2) % 3], corners[exit], corners[(exit + 1) % 3]]
+        current = start
+
+        while True:
+            u, v = strip[-2], strip[-1]
+            corners = triangles[current]
+
+            for k in range(3):
+                if corners[k] in (u, v) and corners[(k + 1) % 3] in (u, v):
+                    break
+
+            following = neighbors[current][k]
+
+            if following < 0 or used[following]:
+                break
+
+            # every second triangle of a strip is flipped, the next one
+            # has to run along the edge the right way round to fit in
+            if len(strip) % 2:
+                u, v = v, u
+
+            corners = triangles[following]
+
+            for k in range(3):
+                if corners[k] == u and corners[(k + 1) % 3] == v:
+                    break
+            else:
+                break
+
+            strip.append(corners[(k + 2) % 3])
+            used[following] = True
+            current = following
+
+        strips.append(strip)
+
+    return strips
+
+def cache_misses(triangles, cache_size=16):
+    # average cache misses per triangle with a fifo post transform cache
+    stamps = [-cache_size] * (triangles.max() + 1 if len(triangles) else 0)
+    misses = 0
+
+    for v in triangles.ravel().tolist():
+        if misses - stamps[v] >= cache_size:
+            stamps[v] = misses
+            misses += 1
+
+    return float(misses) / max(len(triangles), 1)
+
+def tipsify(triangles, count, cache_size=16):
+    # the order to draw the triangles in for fewer vertex cache misses, fans
+    # out around a vertex that is still in the cache or would be soon enough.
+    # after Sander, Nehab and Barczak, "Fast Triangle Reordering for Vertex
+    # Locality and Reduced Overdraw"
+    if not len(triangles):
+        return numpy.zeros(0, numpy.int64)
+
+    offsets, incident = compressed_rows(triangles.ravel(),
+            numpy.arange(len(triangles)).repeat(3), count)
+
+    offsets = offsets.tolist()
+    incident = incident.tolist()
+    corners = triangles.tolist()
+
+    live = numpy.diff(offsets).tolist()
+    stamps = [0] * count
+    emitted = [False] * len(corners)
+    dead_ends = []
+    order = []
+
+    time = cache_size + 1
+    cursor = 0
+    fanning = 0
+
+    while fanning >= 0:
+        candidates = set()
+
+        for t in incident[offsets[fanning]:offsets[fanning + 1]]:
+            if emitted[t]:
+                continue
+
+            emitted[t] = True
+            order.append(t)
+
+            for v in corners[t]:
+                dead_ends.append(v)
+                candidates.add(v)
+                live[v] -= 1
+
+                if time - stamps[v] > cache_size:
+                    stamps[v] = time
+                    time += 1
+
+        # the candidate that stays in the cache the longest while it is used up
+        fanning = -1
+        best = -1
+
+        for v in candidates:
+            if live[v] > 0:
+                priority = time - stamps[v] if time - stamps[v] + 2 * live[v] <= cache_size else 0
+
+                if priority > best:
+                    best = priority
+                    fanning = v
+
+        # otherwise go back to a recent vertex or just the next one with anything left
+        while fanning < 0 and dead_ends:
+            v = dead_ends.pop()
+            if live[v] > 0:
+                fanning = v
+
+        while fanning < 0 and cursor < count:
+            if live[cursor] > 0:
+                fanning = cursor
+            cursor += 1
+
+    return numpy.array(order, numpy.int64)
+
+def fetch_order(vertex_indices, count):
+    # vertices renumbered by their first use, unused ones go last
+    used, first = numpy.unique(vertex_indices, return_index=True)
+    order = numpy.concatenate((used[numpy.argsort(first, kind='mergesort')],
+        numpy.setdiff1d(numpy.arange(count), used)))
+
+    numbers = numpy.empty(count, numpy.int32)
+    numbers[order] = numpy.arange(count)
+
+    return order, numbers
 
 class GraphNode:
 
@@ -74,62 +1061,267 @@ class GraphNode:
         self.faces = set()
         self.neighbors = set()
 
-class ObjObject:
+class ObjObject(object):
 
-    def __init__(self, file_name, color=(1, 0, 1), color_fun=False):
+    def __init__(self, file_name, color=(1, 0, 1), color_fun=False, cache=True, processes=1):
         self.color = color
         self.color_fun = color_fun
+        self.file_name = file_name
+        self.bounding = None
+        self.set_strip_arrays(numpy.zeros((0, 3)), [])
 
-        self.vertices = vertices = []
-        self.normals = normals = []
-        self.texture = texture = []
-        self.faces = faces = []
-        self.strips = strips = []
-        
-        inp = open(file_name)
-
-        actions = {
-                'v': lambda l: vertices.append(Vector(float(i) for i in l)),
-                'vn': lambda l: normals.append(Vector(float(i) for i in l)),
-                'vt': lambda l: texture.append(tuple(float(i) for i in l)),
-                'f': lambda l: faces.append([face_item(i) for i in l]),
-                }
+        mesh = load_mesh(file_name, cache, processes)
+
+        self.vertex_array = mesh['vertices']
+        self.normal_array = mesh['normals']
+        self.texture_array = mesh['texture']
+        self.set_face_arrays(mesh['corners'], mesh['sizes'])
+
+    # the arrays hold the mesh, the lists are built on demand as a view for
+    # the Vector based code, assign to them to write changes back
+
+    @property
+    def vertex_array(self):
+        return self._vertex_array
+
+    @vertex_array.setter
+    def vertex_array(self, array):
+        self._vertex_array = numpy.asarray(array, numpy.float32).reshape(-1, 3)
+        self._vertices = None
+        self.bounding = None
+
+    @property
+    def vertices(self):
+        if self._vertices is None:
+            self._vertices = [Vector(v) for v in self.vertex_array.tolist()]
+
+        return self._vertices
+
+    @vertices.setter
+    def vertices(self, vertices):
+        self.vertex_array = [list(v) for v in vertices]
+
+    @property
+    def normal_array(self):
+        return self._normal_array
+
+    @normal_array.setter
+    def normal_array(self, array):
+        self._normal_array = numpy.asarray(array, numpy.float32).reshape(-1, 3)
+        self._normals = None
+
+    @property
+    def normals(self):
+        if self._normals is None:
+            self._normals = [Vector(v) for v in self.normal_array.tolist()]
+
+        return self._normals
 
-        for line in inp:
-            if line[0] != '#' and not line.isspace():
-                args = line.split()
+    @normals.setter
+    def normals(self, normals):
+        self.normal_array = [list(v) for v in normals]
 
-                cmd = args[0]
+    @property
+    def texture_array(self):
+        return self._texture_array
 
-                if cmd in actions:
-                    actions[args[0]](args[1:])
-                else:
-                    warn("Unknown command: " + cmd)
+    @texture_array.setter
+    def texture_array(self, array):
+        array = numpy.asarray(array, numpy.float32)
+
+        if array.ndim != 2:
+            array = array.reshape(-1, 2)
+
+        self._texture_array = array
+        self._texture = None
+
+    @property
+    def texture(self):
+        if self._texture is None:
+            self._texture = [tuple(t) for t in self.texture_array.tolist()]
+
+        return self._texture
+
+    @texture.setter
+    def texture(self, texture):
+        width = max(len(t) for t in texture) if texture else 2
+        self.texture_array = [list(t) + [0] * (width - len(t)) for t in texture]
+
+    @property
+    def face_array(self):
+        return self._face_array
+
+    @property
+    def face_sizes(self):
+        return self._face_sizes
+
+    def set_face_arrays(self, corners, sizes):
+        # the v, vt and vn index of each corner, counting from 0 and -1 if missing
+        self._face_array = numpy.asarray(corners, numpy.int32).reshape(-1, 3)
+        self._face_sizes = numpy.asarray(sizes, numpy.int32).ravel()
+        self._faces = None
+        self._adjacency = None
+        self._incidence = None
+
+    @property
+    def faces(self):
+        if self._faces is None:
+            self._faces = corner_lists(self.face_array, self.face_sizes)
+
+        return self._faces
+
+    @faces.setter
+    def faces(self, faces):
+        self.set_face_arrays(*corner_arrays(faces))
+
+    # triangle strips are kept the same way as the faces
+
+    @property
+    def strip_array(self):
+        return self._strip_array
+
+    @property
+    def strip_sizes(self):
+        return self._strip_sizes
+
+    def set_strip_arrays(self, corners, sizes):
+        self._strip_array = numpy.asarray(corners, numpy.int32).reshape(-1, 3)
+        self._strip_sizes = numpy.asarray(sizes, numpy.int32).ravel()
+        self._strips = None
+
+    @property
+    def strips(self):
+        if self._strips is None:
+            self._strips = corner_lists(self.strip_array, self.strip_sizes)
+
+        return self._strips
+
+    @strips.setter
+    def strips(self, strips):
+        self.set_strip_arrays(*corner_arrays(strips))
+
+    def strip_corners(self):
+        # the strips unrolled into triangles, three corners each
+        triangles = polygon_triangles(numpy.zeros(0, numpy.int32), self.strip_sizes)[0]
+        return self.strip_array[triangles.ravel()]
+
+    def faces_only(self, action):
+        # whatever only looks at the faces would miss the triangles in strips
+        if len(self.strip_sizes):
+            raise ValueError("%s has to be done before building strips" % action)
+
+    # connectivity as (offsets, indices), the entries of vertex i are
+    # indices[offsets[i]:offsets[i+1]], kept until the faces change
+
+    def adjacency(self):
+        self.faces_only("Finding neighbors")
+        count = len(self.vertex_array)
+
+        if self._adjacency is None or len(self._adjacency[0]) != count + 1:
+            self._adjacency = adjacency(self.face_array[:, 0], self.face_sizes, count)
+
+        return self._adjacency
+
+    def incidence(self):
+        self.faces_only("Finding incident faces")
+        count = len(self.vertex_array)
+
+        if self._incidence is None or len(self._incidence[0]) != count + 1:
+            self._incidence = incidence(self.face_array[:, 0], self.face_sizes, count)
+
+        return self._incidence
+
+    def neighbors(self, index):
+        offsets, neighbors = self.adjacency()
+        return neighbors[offsets[index]:offsets[index + 1]]
+
+    def bounds(self):
+        if self.bounding == None:
+            self.bounding = ucgf.bounding_volume(self.vertex_array)
+
+        return self.bounding and self.bounding[:2]
+
+    def bounding_sphere(self):
+        self.bounds()
+        return self.bounding and self.bounding[2:]
 
     def save_obj(self, file_name):
-        parts = [
-                ('v', self.vertices, str),
-                ('vt', self.texture, str),
-                ('vn', self.normals, str),
-                ('f', self.faces, face_str),
-                ]
+        # compressed if the name ends with .gz
+        out = open_obj(file_name, 'wb')
+
+        try:
+            write_rows(out, 'v', self.vertex_array)
+            write_rows(out, 'vt', self.texture_array)
+            write_rows(out, 'vn', self.normal_array)
+            write_faces(out, self.face_array, self.face_sizes)
+
+            # obj has no strips, they are written as plain triangles
+            strips = self.strip_corners()
+            write_faces(out, strips, numpy.repeat(3, len(strips) // 3))
+        finally:
+            out.close()
+
+    def fill_normals(self):
+        # smooth normals for the corners without one, stored with the mesh
+        # so that rendering only has to look them up
+        faces, strips = self.face_array.copy(), self.strip_array.copy()
+        face_missing, strip_missing = faces[:, 2] < 0, strips[:, 2] < 0
+
+        if not face_missing.any() and not strip_missing.any():
+            return
+
+        indices = numpy.concatenate((faces[:, 0], self.strip_corners()[:, 0]))
+        sizes = numpy.concatenate((self.face_sizes, numpy.repeat(3, (len(indices) - len(faces)) // 3)))
+        normals, corner_normals = vertex_normals(self.vertex_array, indices, sizes)
+
+        # without a crease angle all corners of a vertex share one normal
+        by_vertex = numpy.zeros(len(self.vertex_array), numpy.int32)
+        by_vertex[indices] = corner_normals + len(self.normal_array)
 
-        out = open(file_name, "w")
+        faces[face_missing, 2] = by_vertex[faces[face_missing, 0]]
+        strips[strip_missing, 2] = by_vertex[strips[strip_missing, 0]]
 
-        for name, items, str_fun in parts:
-            for item in items:
-                out.write(name)
+        self.normal_array = numpy.concatenate((self.normal_array, normals))
+        self.set_face_arrays(faces, self.face_sizes)
+        self.set_strip_arrays(strips, self.strip_sizes)
 
-                for sub in item:
-                    out.write(" ")
-                    out.write(str_fun(sub))
+    def triangle_arrays(self):
+        self.fill_normals()
 
-                out.write("\n")
+        vertices = self.vertex_array
+        color_fun = self.color_fun
+
+        # the strips are lined up behind the faces
+        corners = numpy.concatenate((self.face_array, self.strip_array))
+        triangles, polygon_i, starts = polygon_triangles(self.face_sizes, self.strip_sizes)
+
+        vert_i = corners[triangles, 0]
+        norm_i = corners[triangles, 2]
 
-        out.close()
+        positions = vertices[vert_i].reshape(-1, 3)
+        normals = self.normal_array[norm_i.ravel()]
+
+        if color_fun:
+            colors = numpy.random.randint(10, 51, (len(starts), 3)) / 50.0
+            colors = numpy.repeat(colors[polygon_i], 3, axis=0).astype(numpy.float32)
+        else:
+            colors = None
+
+        return positions, normals, colors
+
+    def triangle_indices(self):
+        # the vertices of every triangle of the faces and the strips
+        corners = numpy.concatenate((self.face_array, self.strip_array))
+        return corners[polygon_triangles(self.face_sizes, self.strip_sizes)[0], 0]
 
     def gl_init(self):
-        self.gl_list = ucgf.list_render(self.raw_render)
+        self.fill_normals()
+
+        if ucgf.use_buffers():
+            self.gl_buffer = ucgf.VertexBuffer(GL_TRIANGLES, *self.triangle_arrays())
+        else:
+            self.gl_buffer = None
+            self.gl_list = ucgf.list_render(self.raw_render)
 
     def raw_render(self):
         color = self.color
@@ -154,16 +1346,6 @@ class ObjObject:
             if color_fun:
                 glColor(*([r.randint(10, 50) / 50.0 for i in range(3)] + [255]))
 
-            # this is very hacky normal calculation (if none given)!
-            if face[0][2] == None:
-                vv = [vertices[i[0] - 1] for i in face]
-                ab = vv[1] - vv[0]
-                ac = vv[2] - vv[0]
-                n = ab.cross(ac)
-                n.normalize()
-
-                glNormal(*n)
-
             # actual rendering of the vertices
             for vert_i, text_i, norm_i in face:
                 vertex = vertices[vert_i - 1]
@@ -178,9 +1360,17 @@ class ObjObject:
             glEnd()
 
     def render(self):
-        glCallList(self.gl_list)
+        if self.gl_buffer != None:
+            color = self.color
+            if color != None:
+                glColor(*color)
+
+            self.gl_buffer.render()
+        else:
+            glCallList(self.gl_list)
 
     def vect_faces(self):
+        self.faces_only("Listing faces")
         vertices = self.vertices
         faces = self.faces
 
@@ -189,190 +1379,164 @@ class ObjObject:
     def graph(self):
         graph = [GraphNode(vertex) for vertex in self.vertices]
 
-        for face in self.faces:
-            l = len(face)
-            for index, (vert_i, _, _) in enumerate(face):
-                for diff in 1, -1:
-                    neighbor_i = face[(index+diff)%l][0]
-                    graph[vert_i-1].neighbors.add(graph[neighbor_i-1])
-
-        return graph
-
-    def strip_triangles(self, samples=1):
-        faces = self.faces
-        vertices = self.vertices
-        strips = self.strips
-        rand = Random()
+        offsets, neighbors = self.adjacency()
+        face_offsets, faces = self.incidence()
 
-        while faces:
-            possible_strips = []
+        for i, node in enumerate(graph):
+            node.neighbors = set(graph[j] for j in neighbors[offsets[i]:offsets[i+1]])
+            node.faces = set(faces[face_offsets[i]:face_offsets[i+1]].tolist())
 
-            for i in range(samples):
-                face_i = rand.randint(0, len(faces))
-                face = faces[face_i]
-                node_i = rand.randint(0, len(faces[face_i]))
+        return graph
 
-                a = vertices[faces[(node_i+1)%len(faces)][0]]
-                b = vertices[faces[(node_i+2)%len(faces)][0]]
+    def strip_triangles(self):
+        # triangles go into strips, everything else and triangles without
+        # a neighbor to go with stay faces. returns the number of new strips
+        # and their average length in triangles
+        corners, sizes = self.face_array, self.face_sizes
+        starts = face_offsets(sizes)
 
-                strip = [face[node_i], a, b]
-                consumed = [face_i]
+        if not (sizes == 3).any():
+            return 0, 0.0
 
-                while True:
-                    for index, other in enumerate(faces):
-                        o_verts = [n[0] for n in other]
-                        if a in o_verts and b in o_verts:
-                            t = a
+        # corners with a different texture or normal index do not connect,
+        # numbering the index pairs first keeps the keys small
+        pairs, pair_ids = numpy.unique((corners[:, 1].astype(numpy.int64) + 1) * (corners.max() + 2) +
+                corners[:, 2] + 1, return_inverse=True)
+        keys, ids = numpy.unique(corners[:, 0].astype(numpy.int64) * len(pairs) + pair_ids,
+                return_inverse=True)
+        first = numpy.zeros(len(keys), numpy.int64)
+        first[ids] = numpy.arange(len(ids))
 
-                            a = b
+        chosen = numpy.flatnonzero(sizes == 3)
+        strips = stripify(ids[starts[chosen, None] + numpy.arange(3)])
 
-                            for i in other:
-                                if i[0] == t:
-                                    b = (i + 1) % len(other)
+        lone = [strip for strip in strips if len(strip) == 3]
+        strips = [strip for strip in strips if len(strip) > 3]
+        strip_sizes = numpy.array([len(strip) for strip in strips], numpy.int32)
 
-                            strip.append(b)
-                            consumed.append(index)
+        self.set_strip_arrays(numpy.concatenate((self.strip_array,
+            corners[first[numpy.concatenate(strips or [[]]).astype(numpy.int64)]])),
+            numpy.concatenate((self.strip_sizes, strip_sizes)))
 
-                            break
-                    else:
-                        break
+        kept = numpy.repeat(sizes, sizes) != 3
+        lone = numpy.array(lone, numpy.int64).reshape(-1, 3)
 
-                possible_strips.append((strip, consumed))
+        self.set_face_arrays(numpy.concatenate((corners[kept], corners[first[lone.ravel()]])),
+                numpy.concatenate((sizes[sizes != 3], numpy.repeat(3, len(lone)))))
 
-            strip, consumed = max(possible_strips, lambda (s, c): len(s))
+        return len(strips), float((strip_sizes - 2).sum()) / max(len(strips), 1)
 
-            for index in consumed:
-                del faces[index]
+    def generate_normals(self, weighting='area', crease=None):
+        # smooth normals for all faces, weighted by 'area' or 'angle', split
+        # along edges sharper than the crease angle in degrees
+        self.faces_only("Generating normals")
 
-            strips.append(strip)
+        corners = self.face_array.copy()
+        self.normal_array, corners[:, 2] = vertex_normals(self.vertex_array, corners[:, 0],
+                self.face_sizes, weighting, crease)
+        self.set_face_arrays(corners, self.face_sizes)
 
-    def triangulate(self):
-        # ear clipping
+    def optimize_cache(self, cache_size=16):
+        # reorders the triangles for the post transform vertex cache and the
+        # vertices for fetching them in that order, other faces go last.
+        # returns the average cache misses per triangle before and after
+        corners, sizes = self.face_array, self.face_sizes
+        count = len(self.vertex_array)
 
-        vertices = self.vertices
-        faces = self.faces
+        chosen = numpy.flatnonzero(sizes == 3)
+        triangles = (face_offsets(sizes)[chosen, None] + numpy.arange(3))
+        before = cache_misses(corners[triangles, 0], cache_size)
 
-        for face in list(faces):
-            l = len(face)
+        triangles = triangles[tipsify(corners[triangles, 0], count, cache_size)]
+        others = numpy.repeat(sizes, sizes) != 3
 
-            # TODO: hacky but speedy
-            if l == 3:
-                continue
+        corners = numpy.concatenate((corners[triangles.ravel()], corners[others]))
+        sizes = numpy.concatenate((numpy.repeat(3, len(triangles)), sizes[sizes != 3]))
 
-            def is_convex(index):
-                a = vertices[face[(index-1)%l][0]-1]
-                b = vertices[face[(index+1)%l][0]-1]
-                p = vertices[face[index][0]-1]
+        order, numbers = fetch_order(corners[:, 0], count)
+        corners[:, 0] = numbers[corners[:, 0]]
 
-                pa = a - p
-                pb = b - p
-                ap = p - a
+        strips = self.strip_array.copy()
+        strips[:, 0] = numbers[strips[:, 0]]
 
-                return pa.cross(pb) * ap.cross(pb) < 0
+        self.vertex_array = self.vertex_array[order]
+        self.set_face_arrays(corners, sizes)
+        self.set_strip_arrays(strips, self.strip_sizes)
 
-            # determine convex and convex nodes
-            convex = set(node for i, node in enumerate(face) if is_convex(i))
+        return before, cache_misses(corners[:len(triangles) * 3, 0].reshape(-1, 3), cache_size)
 
-            # just enough iterations to triangulate the face
-            for i in range(l-3):
-                # get all convex nodes with index
-                convex_nodes = [(i, n) for i, n in enumerate(face) if n in convex]
+    def triangulate(self):
+        # faces with less than three corners are dropped
+        self.faces_only("Triangulating")
+        corners = triangulate_faces(self.vertex_array, self.face_array[:, 0], self.face_sizes)
+        self.set_face_arrays(self.face_array[corners.ravel()], numpy.repeat(3, len(corners)))
 
-                # test each convex node
-                for index, node in reversed(convex_nodes):
-                    # find neighbors
-                    prev = face[(index-1)%l]
-                    foll = face[(index+1)%l]
+    def noise(self, sigma):
+        self.vertex_array = numpy.random.normal(self.vertex_array, sigma)
 
-                    # check for collisions with concave nodes
-                    for conc_node in (n for n in face if n not in convex):
-                        point = vertices[conc_node[0]-1]
-                        triangle = [vertices[n[0]-1] for n in prev, node, foll]
+    def smooth(self, alpha, depth=1, weights='uniform', taubin=False):
+        # each step keeps alpha of a vertex and moves the rest towards the
+        # average of its neighbors, taubin follows it with a step back that
+        # keeps the mesh from shrinking
+        factors = [1. - alpha]
 
-                        if in_triangle(point, triangle):
-                            break
-                    else:
-                        # remove the ear
-                        l -= 1
-                        del face[index]
+        if taubin and factors[0]:
+            factors.append(1. / (TAUBIN_PASS - 1. / factors[0]))
 
-                        # add a new triangle
-                        faces.append([prev, node, foll])
+        offsets, neighbors = self.adjacency()
 
-                        # re-classify previous node
-                        if prev not in convex:
-                            if is_convex(index-1):
-                                convex.add(prev)
+        # vertices without neighbors stay where they are
+        lonely = numpy.diff(offsets) == 0
 
-                        # re-classify following node
-                        if foll not in convex:
-                            if is_convex(index):
-                                convex.add(prev)
+        if lonely.any():
+            warn("Vertex without neighbor")
 
-                        # let's have another run
-                        break
+        vertices = self.vertex_array.astype(numpy.float64)
 
-    def noise(self, sigma):
-        rand = Random()
-        self.vertices = [Vector(rand.gauss(x, sigma) for x in vertex)
-                for vertex in self.vertices]
+        # the weights are taken from the mesh as it is before smoothing
+        average = averaging(vertices, self.face_array[:, 0], self.face_sizes,
+                offsets, neighbors, weights)
 
-    def smooth(self, alpha, depth=1):
         for _ in range(depth):
-            print _
-
-            vertices = []
-
-            for node in self.graph():
-                neighbors = node.neighbors
+            for factor in factors:
+                balance = average(vertices)
+                balance[lonely] = vertices[lonely]
 
-                balance = Vector(0, 0, 0)
+                vertices = vertices + factor * (balance - vertices)
 
-                for neighbor in neighbors:
-                    balance += neighbor.vertex
-
-                if len(neighbors) > 0:
-                    balance *= 1.0 / len(neighbors)
-                else:
-                    warn("Vertex without neighbor")
-
-                vertices.append(alpha * node.vertex + (1 - alpha) * balance)
-
-            self.vertices = vertices
+        self.vertex_array = vertices
 
     def center(self):
-        vertices = self.vertices
+        vertices = self.vertex_array
 
         if len(vertices) == 0:
             return
 
-        maxs = list(vertices[0])
-        mins = list(vertices[0])
+        aabb_center = (vertices.min(0) + vertices.max(0)) * 0.5
 
-        for vertex in vertices[1:]:
-            for axis, part in enumerate(vertex):
-                if part < mins[axis]:
-                    mins[axis] = part
-                if part > maxs[axis]:
-                    maxs[axis] = part
-
-        aabb_center = (ucgf.Vector(mins) + ucgf.Vector(maxs)) * 0.5
-
-        self.vertices = [v - aabb_center for v in vertices]
+        self.vertex_array = vertices - aabb_center
 
     def normalize(self):
-        vertices = self.vertices
-        factor = 1. / max(v.size() for v in vertices)
-        self.vertices = [v * factor for v in vertices]
+        vertices = self.vertex_array
+        factor = 1. / numpy.sqrt((vertices ** 2).sum(1)).max()
+        self.vertex_array = vertices * factor
+
+def report(message, values):
+    print message % values
 
 def main(argv):
     obj = ObjObject(argv[0], color_fun=True)
 
     actions = {
-            'smooth': lambda a=0.3, n=1: obj.smooth(float(a), int(n)),
+            'smooth': lambda a=0.3, n=1, w='uniform': obj.smooth(float(a), int(n), w),
+            'taubin': lambda a=0.5, n=1, w='uniform': obj.smooth(float(a), int(n), w, True),
             'noise': lambda s=0.01: obj.noise(float(s)),
             'obj': lambda fn='tmp.obj': obj.save_obj(fn),
             'ear': lambda: obj.triangulate(),
+            'normals': lambda w='area', c=None: obj.generate_normals(w, c and float(c)),
+            'strip': lambda: report("%i strips, %.1f triangles on average", obj.strip_triangles()),
+            'cache': lambda k=16: report("%.3f misses per triangle before, %.3f after",
+                obj.optimize_cache(int(k))),
             'center': obj.center,
             'normalize': obj.normalize
             }
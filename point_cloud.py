@@ -28,16 +28,29 @@ class PointCloud:
 
     def __init__(self, vectors=[]):
         self.vectors = vectors
+        self.bounding = None
 
         self.props = props = ucgf.PropFarm()
         props.add('list_mode', ucgf.Switch(K_l))
         props.add('point_size', ucgf.Slider((K_PERIOD, K_COMMA), start=1, end=100, step=4))
 
     def gl_init(self):
-        self.gl_list = gl_list = glGenLists(1)
-        glNewList(gl_list, GL_COMPILE)
-        self.raw_render()
-        glEndList()
+        if ucgf.use_buffers() and self.vectors:
+            points, normals = zip(*self.vectors)
+            self.gl_buffer = ucgf.VertexBuffer(GL_POINTS, points, normals)
+        else:
+            self.gl_buffer = None
+            self.gl_list = ucgf.list_render(self.raw_render)
+
+    def bounds(self):
+        if self.bounding == None and self.vectors:
+            self.bounding = ucgf.bounding_volume([point for point, normal in self.vectors])
+
+        return self.bounding and self.bounding[:2]
+
+    def bounding_sphere(self):
+        self.bounds()
+        return self.bounding and self.bounding[2:]
 
     def raw_render(self):
         glColor(0, 1, 0)
@@ -54,7 +67,11 @@ class PointCloud:
         glPointSize(self.props['point_size'])
 
         if self.props['list_mode']:
-            glCallList(self.gl_list)
+            if self.gl_buffer != None:
+                glColor(0, 1, 0)
+                self.gl_buffer.render()
+            else:
+                glCallList(self.gl_list)
         else:
             self.raw_render()
 
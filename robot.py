@@ -22,6 +22,8 @@ from pygame.locals import *
 from OpenGL.GL import *
 from OpenGL.GLU import *
 
+import numpy
+
 import ucgf
 
 print "ROBOTS ARE TAKING OVER"
@@ -75,10 +77,16 @@ class Robot:
                 'claw': claw,
                 }
 
+        self.limbs = ucgf.InstancedMesh(limb)
+        self.claws = ucgf.InstancedMesh(claw)
+
     def gl_init(self):
         for obj in self.parts.itervalues():
             obj.gl_init()
 
+        self.limbs.gl_init()
+        self.claws.gl_init()
+
     def update(self, runtime, keys):
         for obj in self.values:
             obj.update(runtime, keys)
@@ -96,22 +104,26 @@ class Robot:
 
         glRotate(self.values[0].value, 0, 1, 0)
 
+        # chain the joints up front and draw all limbs at once
+        joint = numpy.identity(4)
+        limbs = []
+
         for slider in values[1:-2]:
-            glRotate(slider.value, -1, 0, 0)
-            parts['limb'].render()
-            glTranslate(0, 6.5, 0)
+            joint = joint.dot(ucgf.rotation(slider.value, -1, 0, 0))
+            limbs.append(joint)
+            joint = joint.dot(ucgf.translation(0, 6.5, 0))
+
+        self.limbs.render(limbs)
+
+        glMultMatrixf(joint.T)
 
         glRotate(values[-2].value, 0, 1, 0)
         parts['head'].render()
 
-        for angle in (90, -90):
-            glPushMatrix()
-
-            glRotate(angle, 0, 1, 0)
-            glTranslate(0, 0, values[-1].value)
-            parts['claw'].render()
+        claws = [ucgf.rotation(angle, 0, 1, 0).dot(ucgf.translation(0, 0, values[-1].value))
+                for angle in (90, -90)]
 
-            glPopMatrix()
+        self.claws.render(claws)
 
         glPopMatrix()
 
@@ -21,12 +21,17 @@
 import pygame
 from pygame.locals import *
 from OpenGL.GL import *
+from OpenGL.GL import shaders
 from OpenGL.GLU import *
 
 import time
 import sys
+import json
+import ctypes
 from math import cos, sin, pi
 
+import numpy
+
 def list_render(render_fun):
     gl_list = glGenLists(1)
 
@@ -36,6 +41,489 @@ def list_render(render_fun):
 
     return gl_list
 
+# how compiled objects are drawn, either 'buffer' or 'list'
+BACKEND = 'buffer'
+
+def use_buffers():
+    # buffer objects need OpenGL 1.5, fall back to display lists without them
+    return BACKEND == 'buffer' and bool(glGenBuffers)
+
+def upload_buffer(data, target=GL_ARRAY_BUFFER, dtype=numpy.float32):
+    data = numpy.ascontiguousarray(data, dtype)
+
+    buf = glGenBuffers(1)
+    glBindBuffer(target, buf)
+    glBufferData(target, data.nbytes, data, GL_STATIC_DRAW)
+    glBindBuffer(target, 0)
+
+    return buf
+
+class VertexBuffer:
+
+    def __init__(self, mode, positions, normals=None, colors=None, indices=None):
+        self.mode = mode
+        self.arrays = []
+
+        positions = numpy.asarray(positions, numpy.float32)
+        self.count = len(positions)
+
+        self.upload(GL_VERTEX_ARRAY, positions,
+                lambda: glVertexPointer(3, GL_FLOAT, 0, None))
+
+        if normals is not None:
+            self.upload(GL_NORMAL_ARRAY, normals,
+                    lambda: glNormalPointer(GL_FLOAT, 0, None))
+
+        if colors is not None:
+            colors = numpy.asarray(colors, numpy.float32)
+            size = colors.shape[1]
+            self.upload(GL_COLOR_ARRAY, colors,
+                    lambda: glColorPointer(size, GL_FLOAT, 0, None))
+
+        if indices is not None:
+            indices = numpy.ravel(indices)
+            self.count = len(indices)
+            self.index_buffer = upload_buffer(indices, GL_ELEMENT_ARRAY_BUFFER, numpy.uint32)
+        else:
+            self.index_buffer = None
+
+    def upload(self, client_state, data, pointer_fun):
+        self.arrays.append((client_state, upload_buffer(data), pointer_fun))
+
+    def render(self):
+        for client_state, buf, pointer_fun in self.arrays:
+            glBindBuffer(GL_ARRAY_BUFFER, buf)
+            glEnableClientState(client_state)
+            pointer_fun()
+
+        if self.index_buffer != None:
+            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
+            glDrawElements(self.mode, self.count, GL_UNSIGNED_INT, None)
+            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+        else:
+            glDrawArrays(self.mode, 0, self.count)
+
+        for client_state, buf, pointer_fun in self.arrays:
+            glDisableClientState(client_state)
+
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+class StaticBatch:
+
+    # merges static meshes with the same color into one buffer each
+
+    def __init__(self):
+        self.parts = []
+        self.groups = []
+        self.bounding = None
+
+    def add(self, obj, transform=None):
+        self.parts.append((obj, transform))
+        self.bounding = None
+
+    def merged(self):
+        groups = {}
+
+        for obj, transform in self.parts:
+            arrays = obj.triangle_arrays()
+            positions, normals = arrays[:2]
+            colors = arrays[2] if len(arrays) > 2 else None
+
+            if transform is not None:
+                transform = numpy.asarray(transform, numpy.float64)
+                positions = positions.dot(transform[:3, :3].T) + transform[:3, 3]
+
+                normals = normals.dot(numpy.linalg.inv(transform[:3, :3]))
+                normals /= numpy.sqrt((normals ** 2).sum(1))[:, None]
+
+            # per vertex colors can all go together, the rest by color
+            if colors is not None:
+                key = 'vertex'
+            elif obj.color == None:
+                key = None
+            else:
+                key = tuple(obj.color)
+
+            groups.setdefault(key, []).append((positions, normals, colors))
+
+        merged = []
+
+        # the meshes without a color go first, they draw in the current one
+        for key, arrays in sorted(groups.items(), key=lambda item: item[0] != None):
+            positions, normals, colors = zip(*arrays)
+
+            positions = numpy.concatenate(positions).astype(numpy.float32)
+            normals = numpy.concatenate(normals).astype(numpy.float32)
+            colors = numpy.concatenate(colors).astype(numpy.float32) if key == 'vertex' else None
+
+            merged.append((key, positions, normals, colors))
+
+        return merged
+
+    def gl_init(self):
+        self.groups = []
+
+        for key, positions, normals, colors in self.merged():
+            if use_buffers():
+                self.groups.append((key, VertexBuffer(GL_TRIANGLES, positions, normals, colors)))
+            else:
+                self.groups.append((key, ArrayList(GL_TRIANGLES, positions, normals, colors)))
+
+    def bounding_sphere(self):
+        if self.bounding == None:
+            spheres = []
+
+            for obj, transform in self.parts:
+                positions = obj.triangle_arrays()[0]
+
+                if transform is not None:
+                    transform = numpy.asarray(transform, numpy.float64)
+                    positions = positions.dot(transform[:3, :3].T) + transform[:3, 3]
+
+                volume = bounding_volume(positions)
+
+                if volume != None:
+                    spheres.append(volume[2:])
+
+            if spheres:
+                self.bounding = merge_spheres(spheres)
+
+        return self.bounding
+
+    def render(self):
+        # the color after a group with per vertex colors is undefined
+        glPushAttrib(GL_CURRENT_BIT)
+
+        for key, group in self.groups:
+            if key != None and key != 'vertex':
+                glColor(*key)
+
+            group.render()
+
+        glPopAttrib()
+
+class ArrayList:
+
+    # the display list fallback for merged arrays
+
+    def __init__(self, mode, positions, normals, colors=None):
+        def render_fun():
+            glEnableClientState(GL_VERTEX_ARRAY)
+            glEnableClientState(GL_NORMAL_ARRAY)
+            glVertexPointer(3, GL_FLOAT, 0, positions)
+            glNormalPointer(GL_FLOAT, 0, normals)
+
+            if colors is not None:
+                glEnableClientState(GL_COLOR_ARRAY)
+                glColorPointer(colors.shape[1], GL_FLOAT, 0, colors)
+
+            glDrawArrays(mode, 0, len(positions))
+
+            glDisableClientState(GL_COLOR_ARRAY)
+            glDisableClientState(GL_NORMAL_ARRAY)
+            glDisableClientState(GL_VERTEX_ARRAY)
+
+        self.gl_list = list_render(render_fun)
+
+    def render(self):
+        glCallList(self.gl_list)
+
+def translation(x, y, z):
+    m = numpy.identity(4)
+    m[:3, 3] = x, y, z
+    return m
+
+def scaling(x, y, z):
+    return numpy.diag((x, y, z, 1.0))
+
+def rotation(angle, x, y, z):
+    # the same matrix glRotate() would multiply with
+    x, y, z = numpy.array((x, y, z), numpy.float64) / (x*x + y*y + z*z) ** 0.5
+    c = cos(angle * pi / 180)
+    s = sin(angle * pi / 180)
+    t = 1 - c
+
+    m = numpy.identity(4)
+    m[:3, :3] = [
+            (x*x*t + c, x*y*t - z*s, x*z*t + y*s),
+            (y*x*t + z*s, y*y*t + c, y*z*t - x*s),
+            (z*x*t - y*s, z*y*t + x*s, z*z*t + c),
+            ]
+
+    return m
+
+INSTANCE_VERTEX_SHADER = """
+#version 120
+
+attribute vec3 position;
+attribute vec3 normal;
+attribute vec4 color;
+attribute mat4 transform;
+attribute mat3 normal_matrix;
+
+varying vec3 eye_position;
+varying vec3 eye_normal;
+varying vec4 base_color;
+
+void main() {
+    vec4 eye = gl_ModelViewMatrix * transform * vec4(position, 1.0);
+
+    eye_position = eye.xyz;
+    eye_normal = gl_NormalMatrix * normal_matrix * normal;
+    base_color = color;
+
+    gl_Position = gl_ProjectionMatrix * eye;
+}
+"""
+
+INSTANCE_FRAGMENT_SHADER = """
+#version 120
+
+varying vec3 eye_position;
+varying vec3 eye_normal;
+varying vec4 base_color;
+
+void main() {
+    // what the fixed pipeline does with the light set up by Scene
+    vec4 light = gl_LightSource[0].position;
+
+    vec3 n = normalize(eye_normal);
+    vec3 l = normalize(light.xyz - eye_position * light.w);
+    vec3 h = normalize(l - normalize(eye_position));
+
+    float diffuse = max(dot(n, l), 0.0);
+    float specular = diffuse > 0.0 ? pow(max(dot(n, h), 0.0), gl_FrontMaterial.shininess) : 0.0;
+
+    vec4 lit = base_color * (gl_LightModel.ambient + gl_LightSource[0].ambient
+            + gl_LightSource[0].diffuse * diffuse)
+            + gl_FrontMaterial.specular * gl_LightSource[0].specular * specular;
+
+    gl_FragColor = vec4(lit.rgb, base_color.a);
+}
+"""
+
+# linked shader programs, by name
+shader_programs = {}
+
+def shader_program(name, vertex, fragment, attributes):
+    if name in shader_programs:
+        return shader_programs[name]
+
+    program = glCreateProgram()
+
+    glAttachShader(program, shaders.compileShader(vertex, GL_VERTEX_SHADER))
+    glAttachShader(program, shaders.compileShader(fragment, GL_FRAGMENT_SHADER))
+
+    for attribute, location in attributes.items():
+        glBindAttribLocation(program, location, attribute)
+
+    glLinkProgram(program)
+
+    if glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
+        raise RuntimeError(glGetProgramInfoLog(program))
+
+    shader_programs[name] = program
+
+    return program
+
+def use_instancing():
+    # instanced arrays need OpenGL 3.3, draw one by one without them
+    return use_buffers() and bool(glCreateProgram) and bool(glDrawArraysInstanced) \
+            and bool(glVertexAttribDivisor)
+
+class InstancedMesh:
+
+    # attribute locations in the instance shader
+    POSITION = 0
+    NORMAL = 1
+    COLOR = 2
+    TRANSFORM = 3
+    NORMAL_MATRIX = 7
+
+    def __init__(self, mesh):
+        self.mesh = mesh
+        self.program = None
+
+    def gl_init(self):
+        if use_instancing():
+            positions, normals = self.mesh.triangle_arrays()[:2]
+
+            self.count = len(positions)
+            self.position_buffer = upload_buffer(positions)
+            self.normal_buffer = upload_buffer(normals)
+            self.instance_buffer = glGenBuffers(1)
+
+            self.program = shader_program('instance',
+                    INSTANCE_VERTEX_SHADER, INSTANCE_FRAGMENT_SHADER, {
+                        'position': self.POSITION,
+                        'normal': self.NORMAL,
+                        'color': self.COLOR,
+                        'transform': self.TRANSFORM,
+                        'normal_matrix': self.NORMAL_MATRIX,
+                        })
+        else:
+            # the instances are drawn one by one then, from the same triangles
+            # as above and without the color of the mesh getting in the way
+            positions, normals = self.mesh.triangle_arrays()[:2]
+
+            if use_buffers():
+                self.gl_buffer = VertexBuffer(GL_TRIANGLES, positions, normals)
+            else:
+                self.gl_buffer = None
+                self.gl_list = list_render(lambda: self.raw_render(positions, normals))
+
+    def raw_render(self, positions, normals):
+        glBegin(GL_TRIANGLES)
+
+        for position, normal in zip(positions, normals):
+            glNormal3fv(normal)
+            glVertex3fv(position)
+
+        glEnd()
+
+    def render(self, transforms, colors=None):
+        transforms = numpy.asarray(transforms, numpy.float32).reshape(-1, 4, 4)
+        count = len(transforms)
+
+        if count == 0:
+            return
+
+        if colors is None:
+            color = self.mesh.color
+            if color == None:
+                color = glGetFloatv(GL_CURRENT_COLOR)
+
+            colors = [color] * count
+
+        colors = numpy.asarray(colors, numpy.float32).reshape(count, -1)
+
+        if colors.shape[1] == 3:
+            colors = numpy.hstack((colors, numpy.ones((count, 1), numpy.float32)))
+
+        if self.program == None:
+            for transform, color in zip(transforms, colors):
+                glPushMatrix()
+                glMultMatrixf(transform.T)
+                glColor(*color)
+
+                if self.gl_buffer != None:
+                    self.gl_buffer.render()
+                else:
+                    glCallList(self.gl_list)
+
+                glPopMatrix()
+
+            return
+
+        # normals need the inverse transposed transformations
+        normal_matrices = numpy.linalg.inv(transforms[:, :3, :3]).transpose(0, 2, 1)
+
+        # matrix attributes are fed column by column
+        data = numpy.hstack((
+                transforms.transpose(0, 2, 1).reshape(count, 16),
+                normal_matrices.transpose(0, 2, 1).reshape(count, 9),
+                colors,
+                )).astype(numpy.float32)
+
+        stride = data.shape[1] * data.itemsize
+
+        instance_attributes = [(self.TRANSFORM + i, 4, i * 4) for i in range(4)] \
+                + [(self.NORMAL_MATRIX + i, 3, 16 + i * 3) for i in range(3)] \
+                + [(self.COLOR, 4, 25)]
+
+        glUseProgram(self.program)
+
+        glBindBuffer(GL_ARRAY_BUFFER, self.instance_buffer)
+        glBufferData(GL_ARRAY_BUFFER, data.nbytes, data, GL_STREAM_DRAW)
+
+        for location, size, offset in instance_attributes:
+            glEnableVertexAttribArray(location)
+            glVertexAttribPointer(location, size, GL_FLOAT, GL_FALSE, stride,
+                    ctypes.c_void_p(offset * data.itemsize))
+            glVertexAttribDivisor(location, 1)
+
+        for location, buf in (self.POSITION, self.position_buffer), (self.NORMAL, self.normal_buffer):
+            glBindBuffer(GL_ARRAY_BUFFER, buf)
+            glEnableVertexAttribArray(location)
+            glVertexAttribPointer(location, 3, GL_FLOAT, GL_FALSE, 0, None)
+
+        glDrawArraysInstanced(GL_TRIANGLES, 0, self.count, count)
+
+        for location, size, offset in instance_attributes:
+            glVertexAttribDivisor(location, 0)
+            glDisableVertexAttribArray(location)
+
+        glDisableVertexAttribArray(self.POSITION)
+        glDisableVertexAttribArray(self.NORMAL)
+
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glUseProgram(0)
+
+def bounding_volume(points):
+    # axis aligned box and a sphere around its center
+    points = numpy.asarray(points, numpy.float64).reshape(-1, 3)
+
+    if len(points) == 0:
+        return None
+
+    lo = points.min(0)
+    hi = points.max(0)
+    center = (lo + hi) * 0.5
+    radius = numpy.sqrt(((points - center) ** 2).sum(1).max())
+
+    return lo, hi, center, radius
+
+def merge_spheres(spheres):
+    centers = numpy.array([center for center, radius in spheres])
+    radii = numpy.array([radius for center, radius in spheres])
+
+    lo = (centers - radii[:, None]).min(0)
+    hi = (centers + radii[:, None]).max(0)
+    center = (lo + hi) * 0.5
+    radius = (numpy.sqrt(((centers - center) ** 2).sum(1)) + radii).max()
+
+    return center, radius
+
+class Frustum:
+
+    def __init__(self, projection, modelview):
+        # OpenGL hands out its matrices column by column
+        clip = numpy.dot(numpy.transpose(projection), numpy.transpose(modelview))
+
+        planes = []
+
+        for row in range(3):
+            planes.append(clip[3] + clip[row])
+            planes.append(clip[3] - clip[row])
+
+        planes = numpy.array(planes)
+        planes /= numpy.sqrt((planes[:, :3] ** 2).sum(1))[:, None]
+
+        self.normals = planes[:, :3]
+        self.offsets = planes[:, 3]
+
+    @classmethod
+    def current(cls):
+        projection = glGetFloatv(GL_PROJECTION_MATRIX)
+        modelview = glGetFloatv(GL_MODELVIEW_MATRIX)
+
+        return cls(projection, modelview)
+
+    def sphere_visible(self, center, radius):
+        return (numpy.dot(self.normals, center) + self.offsets >= -radius).all()
+
+    def visible(self, obj):
+        # objects without bounds can't be culled
+        if not hasattr(obj, 'bounding_sphere'):
+            return True
+
+        sphere = obj.bounding_sphere()
+
+        if sphere == None:
+            return True
+
+        return self.sphere_visible(*sphere)
+
 class Vector:
 
     def __init__(self, *data):
@@ -101,21 +589,103 @@ class Vector:
     def normalize(self):
         self *= 1. / self.size()
 
-class PolyPackage:
+class PolyPackage(object):
 
     def __init__(self, color=(1, 0, 1), invert_normals=False):
-        self.polygons = []
+        self._positions = numpy.zeros((0, 3), numpy.float32)
+        self._indices = numpy.zeros((0, 3), numpy.int32)
+        self.pending = []
+        self.vertex_count = 0
+        self.normals = None
+        self.bounding = None
+
         self.color = color
-        self.invert_normals = invert_normals
+        self._invert_normals = bool(invert_normals)
 
     def add(self, a, b, c):
-        self.polygons.append([a, b, c])
+        # either one triangle or three equally long arrays of corners
+        corners = numpy.array([a, b, c], numpy.float32).reshape(3, -1, 3)
+        corners = corners.swapaxes(0, 1).reshape(-1, 3)
+
+        indices = numpy.arange(len(corners), dtype=numpy.int32).reshape(-1, 3)
+
+        self.add_indexed(corners, indices)
+
+    def add_indexed(self, positions, indices):
+        positions = numpy.array(positions, numpy.float32).reshape(-1, 3)
+        indices = numpy.asarray(indices, numpy.int32).reshape(-1, 3)
+
+        self.pending.append((positions, indices + self.vertex_count))
+        self.vertex_count += len(positions)
+        self.normals = None
+        self.bounding = None
+
+    def compact(self):
+        if not self.pending:
+            return
+
+        positions, indices = zip(*self.pending)
+        self._positions = numpy.concatenate((self._positions,) + positions)
+        self._indices = numpy.concatenate((self._indices,) + indices)
+        self.pending = []
+
+    @property
+    def positions(self):
+        self.compact()
+        return self._positions
+
+    @property
+    def indices(self):
+        self.compact()
+        return self._indices
+
+    @property
+    def polygons(self):
+        return [[Vector(v) for v in polygon]
+                for polygon in self.positions[self.indices].tolist()]
 
     def assimilate(self, obj):
-        self.polygons.extend(obj.polygons)
+        self.add_indexed(obj.positions, obj.indices)
+
+    @property
+    def invert_normals(self):
+        return self._invert_normals
+
+    @invert_normals.setter
+    def invert_normals(self, value):
+        value = bool(value)
+
+        # no need to recalculate anything, just flip the cached normals
+        if value != self._invert_normals and self.normals is not None:
+            self.normals *= -1
+
+        self._invert_normals = value
+
+    def face_normals(self):
+        if self.normals is None:
+            a, b, c = self.positions[self.indices].swapaxes(0, 1)
+            normals = numpy.cross(b - a, c - a)
+            normals /= numpy.sqrt((normals ** 2).sum(1))[:, None]
+
+            if self.invert_normals:
+                normals *= -1
+
+            self.normals = normals
+
+        return self.normals
+
+    def triangle_arrays(self):
+        positions = self.positions[self.indices].reshape(-1, 3)
+        normals = numpy.repeat(self.face_normals(), 3, axis=0)
+
+        return positions, normals
 
     def gl_init(self):
-        self.gl_list = list_render(self.raw_render)
+        if use_buffers():
+            self.gl_buffer = VertexBuffer(GL_TRIANGLES, *self.triangle_arrays())
+        else:
+            self.gl_buffer = None
+            self.gl_list = list_render(self.raw_render)
 
     def raw_render(self):
         color = self.color
@@ -124,44 +694,69 @@ class PolyPackage:
 
         glBegin(GL_TRIANGLES)
 
-        for polygon in self.polygons:
-            ab = polygon[1] - polygon[0]
-            ac = polygon[2] - polygon[0]
-            n = ab.cross(ac)
-            n.normalize()
-
-            if self.invert_normals:
-                n = -1 * n
-
-            glNormal(*n)
+        for normal, polygon in zip(self.face_normals(), self.positions[self.indices]):
+            glNormal3fv(normal)
 
             for vector in polygon:
-                glVertex(vector)
+                glVertex3fv(vector)
 
         glEnd()
 
     def render(self):
-        glCallList(self.gl_list)
+        if self.gl_buffer != None:
+            color = self.color
+            if color != None:
+                glColor(*color)
 
-    def translate(self, x, y, z):
-        delta = (x, y, z)
+            self.gl_buffer.render()
+        else:
+            glCallList(self.gl_list)
+
+    def bounds(self):
+        if self.bounding == None:
+            self.bounding = bounding_volume(self.positions)
+
+        return self.bounding and self.bounding[:2]
+
+    def bounding_sphere(self):
+        self.bounds()
+        return self.bounding and self.bounding[2:]
 
-        for polygon in self.polygons:
-            for index in range(3):
-                polygon[index] = polygon[index] + delta
+    def translate(self, x, y, z):
+        # moving the mesh does not change the orientation of its faces
+        self.positions[:] += (x, y, z)
+        self.bounding = None
 
     def scale(self, x, y, z):
-        factor = Vector(x, y, z)
+        self.positions[:] *= (x, y, z)
+        self.normals = None
+        self.bounding = None
+
+def set_static(updatables, obj, static):
+    # static objects are skipped when updating
+    obj.static = static
 
-        for polygon in self.polygons:
-            for index in range(3):
-                polygon[index] = polygon[index] * factor
+    if static:
+        if obj in updatables:
+            updatables.remove(obj)
+    elif hasattr(obj, 'update') and obj not in updatables:
+        updatables.append(obj)
 
 class Composite:
 
     def __init__(self):
         self.objects = []
+        self.updatables = []
+        self.renderables = []
         self.initialized = False
+        self.stats = None
+        self.cull = True
+
+    def set_stats(self, stats):
+        self.stats = stats
+
+        for obj in self.objects:
+            if isinstance(obj, Composite): obj.set_stats(stats)
 
     def gl_init(self):
         self.initialized = True
@@ -172,16 +767,62 @@ class Composite:
     def add(self, obj):
         self.objects.append(obj)
 
+        # sort the object in once instead of asking on every frame
+        if hasattr(obj, 'update') and not getattr(obj, 'static', False):
+            self.updatables.append(obj)
+
+        if hasattr(obj, 'render'):
+            self.renderables.append(obj)
+
+        if isinstance(obj, Composite):
+            obj.set_stats(self.stats)
+
         if self.initialized:
             if hasattr(obj, 'gl_init'): obj.gl_init()
 
+    def set_static(self, obj, static=True):
+        set_static(self.updatables, obj, static)
+
     def update(self, runtime, keys):
-        for obj in self.objects:
-            if hasattr(obj, 'update'): obj.update(runtime, keys)
+        stats = self.stats
+
+        for obj in self.updatables:
+            if stats:
+                stats.call(obj, 'update', runtime, keys)
+            else:
+                obj.update(runtime, keys)
+
+    def bounding_sphere(self):
+        # in the space of the children, subclasses moving them around in
+        # render() have to move the sphere along
+        spheres = []
+
+        for obj in self.renderables:
+            sphere = obj.bounding_sphere() if hasattr(obj, 'bounding_sphere') else None
+
+            # one unbounded child makes the whole composite unbounded
+            if sphere == None:
+                return None
+
+            spheres.append(sphere)
+
+        if not spheres:
+            return None
+
+        return merge_spheres(spheres)
 
     def render(self):
-        for obj in self.objects:
-            if hasattr(obj, 'render'): obj.render()
+        stats = self.stats
+        frustum = Frustum.current() if self.cull else None
+
+        for obj in self.renderables:
+            if frustum and not frustum.visible(obj):
+                continue
+
+            if stats:
+                stats.call(obj, 'render')
+            else:
+                obj.render()
 
 class Switch:
 
@@ -248,14 +889,189 @@ class PropFarm:
         for prop in self.props.itervalues():
             prop.update(runtime, keys)
 
+def is_animating(obj):
+    if isinstance(obj, Composite):
+        return any(is_animating(child) for child in obj.objects)
+    else:
+        return getattr(obj, 'animating', False)
+
+class FrameRate:
+
+    # sleeps until the next frame is due, late frames are caught up on
+
+    def __init__(self, fps=60):
+        self.period = 1.0 / fps
+        self.due = None
+
+    def setup(self):
+        pass
+
+    def wait(self, scene, keys):
+        now = time.time()
+
+        if self.due == None:
+            self.due = now
+
+        self.due += self.period
+        delay = self.due - now
+
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -self.period:
+            # hopelessly behind, don't rush through the next frames
+            self.due = now
+
+        return False
+
+class Uncapped:
+
+    def setup(self):
+        pass
+
+    def wait(self, scene, keys):
+        return False
+
+class VSync:
+
+    # flip() blocks on the vertical retrace, no need to sleep on our own
+
+    def setup(self):
+        if hasattr(pygame, 'GL_SWAP_CONTROL'):
+            pygame.display.gl_set_attribute(pygame.GL_SWAP_CONTROL, 1)
+
+    def wait(self, scene, keys):
+        return False
+
+class Idle:
+
+    # blocks until the next event while nothing is animating
+
+    def __init__(self, active=None):
+        self.active = FrameRate() if active == None else active
+
+    def setup(self):
+        self.active.setup()
+
+    def wait(self, scene, keys):
+        if keys or any(is_animating(obj) for obj in scene.objects):
+            return self.active.wait(scene, keys)
+        else:
+            pygame.event.post(pygame.event.wait())
+
+            # the time spent waiting should not show up as runtime
+            return True
+
+class FrameStats:
+
+    PHASES = ('events', 'update', 'view', 'render', 'flip', 'wait')
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.frames = numpy.zeros((size, len(self.PHASES)))
+        self.count = 0
+        self.row = 0
+        self.mark = time.time()
+
+        # per object update and render durations, aligned with the frames
+        self.objects = {}
+        self.labels = {}
+
+    def start_frame(self):
+        self.row = self.count % self.size
+        self.frames[self.row] = 0
+
+        for durations in self.objects.itervalues():
+            durations[self.row] = numpy.nan
+
+        self.mark = time.time()
+
+    def lap(self, phase):
+        now = time.time()
+        self.frames[self.row, self.PHASES.index(phase)] += now - self.mark
+        self.mark = now
+
+    def end_frame(self):
+        self.count += 1
+
+    def label(self, obj):
+        key = id(obj)
+
+        if key not in self.labels:
+            name = getattr(obj, 'name', obj.__class__.__name__)
+            taken = sum(1 for label in self.labels.itervalues() if label.startswith(name + '#'))
+            self.labels[key] = label = '%s#%i' % (name, taken)
+
+            self.objects[label] = numpy.empty((self.size, 2))
+            self.objects[label][:] = numpy.nan
+
+        return self.labels[key]
+
+    def call(self, obj, phase, *args):
+        durations = self.objects[self.label(obj)]
+
+        start = time.time()
+        getattr(obj, phase)(*args)
+        durations[self.row, ('update', 'render').index(phase)] = time.time() - start
+
+    def recorded(self):
+        # the filled part of the ring buffer, oldest frame first
+        if self.count < self.size:
+            return numpy.arange(self.count)
+        else:
+            return numpy.roll(numpy.arange(self.size), -(self.count % self.size))
+
+    def percentiles(self, values, q=(50, 95, 99)):
+        values = values[~numpy.isnan(values)]
+
+        if len(values) == 0:
+            return None
+
+        return dict(('p%i' % p, v) for p, v in zip(q, numpy.percentile(values, q)))
+
+    def summary(self):
+        frames = self.frames[self.recorded()]
+
+        phases = dict((phase, self.percentiles(frames[:, index]))
+                for index, phase in enumerate(self.PHASES))
+        phases['frame'] = self.percentiles(frames.sum(1))
+
+        objects = {}
+
+        for label, durations in self.objects.iteritems():
+            durations = durations[self.recorded()]
+            objects[label] = {
+                    'update': self.percentiles(durations[:, 0]),
+                    'render': self.percentiles(durations[:, 1]),
+                    }
+
+        return {
+                'frames': len(frames),
+                'phases': phases,
+                'objects': objects,
+                }
+
+    def dump(self, file_name):
+        data = self.summary()
+        data['frame_times'] = self.frames[self.recorded()].tolist()
+        data['frame_phases'] = self.PHASES
+
+        out = open(file_name, 'w')
+        json.dump(data, out, indent=2, separators=(',', ': '))
+        out.close()
+
 class Scene:
 
-    def __init__(self, size=(800,600)):
+    def __init__(self, size=(800,600), stats=None, scheduler=None):
         self.objects = []
+        self.updatables = []
+        self.renderables = []
+        self.stats = stats
+        self.scheduler = FrameRate() if scheduler == None else scheduler
 
         pygame.display.init()
         pygame.display.set_caption("Uber Cool Graphics Framework")
 
+        self.scheduler.setup()
         self.init_cam(size)
         self.init_light()
 
@@ -308,14 +1124,30 @@ class Scene:
 
     def add(self, obj):
         self.objects.append(obj)
-        
+
+        if hasattr(obj, 'update') and not getattr(obj, 'static', False):
+            self.updatables.append(obj)
+
+        if hasattr(obj, 'render'):
+            self.renderables.append(obj)
+
+        if isinstance(obj, Composite):
+            obj.set_stats(self.stats)
+
         if hasattr(obj, 'gl_init'): obj.gl_init()
 
+    def set_static(self, obj, static=True):
+        set_static(self.updatables, obj, static)
+
     def loop(self):
         last = time.time()
         keys = set()
 
+        stats = self.stats
+
         while True:
+            if stats: stats.start_frame()
+
             events = pygame.event.get()
 
             for event in events:
@@ -325,22 +1157,44 @@ class Scene:
                     keys.add(event.key)
                 elif event.type == KEYUP:
                     keys.discard(event.key)
-            
+
+            if stats: stats.lap('events')
+
             now = time.time()
             time_diff = now - last
 
-            for obj in self.objects:
-                if hasattr(obj, 'update'): obj.update(time_diff, keys)
+            for obj in self.updatables:
+                if stats:
+                    stats.call(obj, 'update', time_diff, keys)
+                else:
+                    obj.update(time_diff, keys)
+
+            if stats: stats.lap('update')
 
             self.view_init()
 
-            for obj in self.objects:
-                if hasattr(obj, 'render'): obj.render()
+            if stats: stats.lap('view')
+
+            for obj in self.renderables:
+                if stats:
+                    stats.call(obj, 'render')
+                else:
+                    obj.render()
+
+            if stats: stats.lap('render')
 
             pygame.display.flip()
 
+            if stats: stats.lap('flip')
+
             last = now
-            time.sleep(0.005)
+
+            if self.scheduler.wait(self, keys):
+                last = time.time()
+
+            if stats:
+                stats.lap('wait')
+                stats.end_frame()
 
 class Showcase(Composite):
 
@@ -362,14 +1216,25 @@ class Showcase(Composite):
 
         Composite.update(self, runtime, keys)
 
-    def render(self):
+    def matrix(self):
         props = self.props
 
-        glPushMatrix()
+        return reduce(numpy.dot, (translation(props['move_x'], props['move_y'], -props['move_z']),
+            rotation(props['angle'], 1, 0, 0), rotation(props['rotate'], 0, 1, 0)))
 
-        glTranslate(props['move_x'], props['move_y'], -props['move_z'])
-        glRotate(props['angle'], 1, 0, 0)
-        glRotate(props['rotate'], 0, 1, 0)
+    def bounding_sphere(self):
+        sphere = Composite.bounding_sphere(self)
+
+        if sphere == None:
+            return None
+
+        # only moved and turned, the radius stays the same
+        center, radius = sphere
+        return numpy.dot(self.matrix(), numpy.append(center, 1))[:3], radius
+
+    def render(self):
+        glPushMatrix()
+        glMultMatrixf(self.matrix().T)
 
         Composite.render(self)
 
@@ -383,7 +1248,7 @@ class Cube(PolyPackage):
         # concept borrowed from twobit
 
         s = (-0.5, 0.5)
-        v = [Vector(x, y, z) for x in s for y in s for z in s]
+        v = [(x, y, z) for x in s for y in s for z in s]
         p = [
                 (0, 1, 3, 2),
                 (6, 7, 5, 4),
@@ -393,71 +1258,115 @@ class Cube(PolyPackage):
                 (0, 2, 6, 4),
             ]
 
-        for p in p:
-            a, b, c, d = (v[i] for i in p)
-            self.add(a, b, c)
-            self.add(c, d, a)
+        indices = []
+
+        for a, b, c, d in p:
+            indices.append((a, b, c))
+            indices.append((c, d, a))
+
+        self.add_indexed(v, indices)
 
         # /twobit
 
+# generated sphere geometry, by level of detail
+sphere_meshes = {}
+
+def sphere_mesh(detail):
+    if detail in sphere_meshes:
+        return sphere_meshes[detail]
+
+    # concept borrowed from twobit
+    s = (-0.5, 0.5)
+    positions = numpy.array([(x, y, z) for x in s for y in s for z in s])
+    squares = numpy.array([
+            (0, 1, 3, 2),
+            (6, 7, 5, 4),
+            (4, 5, 1, 0),
+            (2, 3, 7, 6),
+            (5, 7, 3, 1),
+            (0, 2, 6, 4),
+        ])
+
+    for level in range(detail):
+        count = len(positions)
+
+        # each edge is shared by two squares, give it only one midpoint
+        edges = squares[:, [[0, 1], [1, 2], [2, 3], [3, 0]]].reshape(-1, 2)
+        edges.sort(axis=1)
+        keys = edges[:, 0] * count + edges[:, 1]
+        keys, first, mids = numpy.unique(keys, return_index=True, return_inverse=True)
+
+        edge_points = positions[edges[first]].mean(1)
+        center_points = positions[squares].mean(1)
+
+        e, f, g, h = (mids + count).reshape(-1, 4).T
+        i = numpy.arange(len(squares)) + count + len(keys)
+        a, b, c, d = squares.T
+
+        squares = numpy.concatenate([
+                numpy.array(square).T for square in [
+                    (a, e, i, h),
+                    (e, b, f, i),
+                    (i, f, c, g),
+                    (h, i, g, d),
+                ]])
+
+        positions = numpy.concatenate((positions, edge_points, center_points))
+
+    # project all corners onto the sphere at once
+    positions *= 0.5 / numpy.sqrt((positions ** 2).sum(1))[:, None]
+    indices = squares[:, [0, 1, 2, 2, 3, 0]].reshape(-1, 3)
+
+    mesh = (positions.astype(numpy.float32), indices.astype(numpy.int32))
+    sphere_meshes[detail] = mesh
+
+    return mesh
+
 class Sphere(PolyPackage):
 
     def __init__(self, detail=3, color=(1, 0, 1)):
         PolyPackage.__init__(self, color)
-        
-        # concept borrowed from twobit
-        s = (-0.5, 0.5)
-        v = [Vector(x, y, z) for x in s for y in s for z in s]
-        p = [
-                (0, 1, 3, 2),
-                (6, 7, 5, 4),
-                (4, 5, 1, 0),
-                (2, 3, 7, 6),
-                (5, 7, 3, 1),
-                (0, 2, 6, 4),
-            ]
-
-        for p in p:
-            self.add_square([v[i] for i in p], detail)
-
-    def add_square(self, (a, b, c, d), levels=0):
-        if levels:
-            e = (a + b) * 0.5
-            f = (b + c) * 0.5
-            g = (c + d) * 0.5
-            h = (d + a) * 0.5
-            i = (a + b + c + d) * 0.25
-
-            self.add_square((a, e, i, h), levels - 1)
-            self.add_square((e, b, f, i), levels - 1)
-            self.add_square((i, f, c, g), levels - 1)
-            self.add_square((h, i, g, d), levels - 1)
-        else:
-            for v in a, b, c, d:
-                v.normalize()
-                v *= 0.5
 
-            self.add(a, b, c)
-            self.add(c, d, a)
+        self.add_indexed(*sphere_mesh(detail))
 
 class Tube(PolyPackage):
 
     def __init__(self, corners, color=(1, 0, 1)):
         PolyPackage.__init__(self, color)
 
-        angles = lambda: (index * pi * 2 / corners for index in range(corners) + [0])
+        angles = numpy.arange(corners) * pi * 2 / corners
+
+        ring = numpy.empty((corners, 3))
+        ring[:, 0] = numpy.cos(angles) / 2
+        ring[:, 2] = numpy.sin(angles) / 2
 
-        up = [Vector(cos(angle)/2, 0.5, sin(angle)/2) for angle in angles()]
-        down = [Vector(cos(angle)/2, -0.5, sin(angle)/2) for angle in angles()]
+        up = ring.copy()
+        up[:, 1] = 0.5
 
-        up_center = Vector(0, 0.5, 0)
-        down_center = Vector(0, -0.5, 0)
+        down = ring.copy()
+        down[:, 1] = -0.5
 
-        for index in range(corners):
-            self.add(up[index], up[index+1], down[index+1])
-            self.add(down[index+1], down[index], up[index])
-            self.add(up[index], up_center, up[index+1])
-            self.add(down[index+1], down_center, down[index])
+        centers = [(0, 0.5, 0), (0, -0.5, 0)]
+
+        positions = numpy.concatenate((up, down, centers))
+
+        # indices into the positions above
+        cur = numpy.arange(corners)
+        nxt = (cur + 1) % corners
+        cur_down = cur + corners
+        nxt_down = nxt + corners
+        up_center = numpy.repeat(corners * 2, corners)
+        down_center = up_center + 1
+
+        indices = numpy.array([
+                (cur, nxt, nxt_down),
+                (nxt_down, cur_down, cur),
+                (cur, up_center, nxt),
+                (nxt_down, down_center, cur_down),
+            ])
+
+        # interleave the four triangles of each segment like before
+        self.add_indexed(positions, indices.transpose(2, 0, 1))
 
 class Benchmarker:
 
@@ -479,8 +1388,24 @@ class Benchmarker:
                 self.bench_start = time.time()
                 self.frames = 1
 
-def show_scene(objects):
-    s = Scene()
+class StatsDumper:
+
+    def __init__(self, stats, key=K_p, file_name='frame_stats.json'):
+        self.stats = stats
+        self.switch = Switch(key, value=False)
+        self.file_name = file_name
+
+    def update(self, runtime, keys):
+        before = self.switch.value
+        self.switch.update(runtime, keys)
+
+        if self.switch.value != before:
+            self.stats.dump(self.file_name)
+            print "Frame statistics written to %s" % self.file_name
+
+def show_scene(objects, scheduler=None):
+    stats = FrameStats()
+    s = Scene(stats=stats, scheduler=scheduler)
     c = Showcase()
 
     for obj in objects:
@@ -488,6 +1413,7 @@ def show_scene(objects):
 
     s.add(c)
     s.add(Benchmarker())
+    s.add(StatsDumper(stats))
     s.loop()
 
 def main(argv):